@@ -0,0 +1,411 @@
+#Usual suspects
+import numpy as np
+from typing import Dict, Optional, List, Union
+import time
+
+# Muograph
+import sys
+sys.path.insert(1,'../muograph/')
+from tracking.tracking import Tracking, angular_features
+from reconstruction.poca import POCA
+from volume.volume import VolumeInterest
+from utils.utils import get_hits_from_csv, save_hits_compact, load_hits_compact
+from utils.dataset import HitsDataset
+
+
+def benchmark_tracking_fit(hits:np.ndarray, n_event:Optional[int]=None, atol:float=1e-8) -> Dict[str,float]:
+
+    '''
+    Compares the batched track fit against the event by event skspatial fit, in terms of
+    computing time and results.
+
+    INPUT:
+     - hits:np.ndarray, the hits with shape (3,n_plane,n_event)
+     - n_event:int, the number of events to use. If None, all events are used
+     - atol:float, the tolerance on the vectors and points coordinates
+
+    OUTPUT:
+     - results:Dict[str,float], the computing times, speedup and maximum deviations
+    '''
+
+    if(n_event is not None):
+        hits = hits[:,:,:n_event]
+
+    start = time.time()
+    tracks_loop = Tracking(hits=hits,fit_method='skspatial')
+    time_loop = time.time()-start
+
+    start = time.time()
+    tracks_svd = Tracking(hits=hits,fit_method='svd')
+    time_svd = time.time()-start
+
+    # A line direction is defined up to its sign
+    sign = np.sign(np.sum(tracks_loop.vectors*tracks_svd.vectors,axis=1,keepdims=True))
+    dv = np.abs(tracks_loop.vectors - sign*tracks_svd.vectors).max()
+    dp = np.abs(tracks_loop.points - tracks_svd.points).max()
+
+    results = {'time_loop':time_loop,
+               'time_svd':time_svd,
+               'speedup':time_loop/time_svd,
+               'max_vector_deviation':dv,
+               'max_point_deviation':dp}
+
+    print("# events = {}".format(hits.shape[-1]))
+    print("skspatial loop: {:.3f} s".format(time_loop))
+    print("batched svd: {:.3f} s (x{:.1f})".format(time_svd,results['speedup']))
+    print("max deviation: vectors = {:.2e}, points = {:.2e} mm".format(dv,dp))
+    assert (dv<atol) & (dp<atol), "Batched fit does not match skspatial within {}".format(atol)
+
+    return results
+
+
+def benchmark_tracking_scaling(hits:np.ndarray, max_workers:Optional[int]=None, fit_method:str='svd') -> Dict[int,float]:
+
+    '''
+    Measures the tracking computing time, fit and angular features, as a function of the number of worker processes.
+
+    INPUT:
+     - hits:np.ndarray, the hits with shape (3,n_plane,n_event)
+     - max_workers:int, the maximum number of workers. If None, the number of cpu cores is used
+     - fit_method:str, the track fitting method
+
+    OUTPUT:
+     - times:Dict[int,float], the computing time for each number of workers
+    '''
+
+    import os
+
+    if(max_workers is None):
+        max_workers = os.cpu_count()
+
+    times = {}
+    for n_workers in range(1,max_workers+1):
+        start = time.time()
+        tracks = Tracking(hits=hits,fit_method=fit_method,n_workers=n_workers)
+        # Angles are computed along with the fit with n_workers > 1, and on first access otherwise:
+        # they are accessed so that every run does the same work
+        for feature in angular_features:
+            getattr(tracks,feature)
+        times[n_workers] = time.time()-start
+
+    print("# events = {}".format(hits.shape[-1]))
+    for n_workers, t in times.items():
+        print("{} worker(s): {:.3f} s (x{:.2f})".format(n_workers,t,times[1]/t))
+
+    return times
+
+
+def benchmark_dataset_scaling(files:Union[str,List[str]], max_workers:Optional[int]=None, dtype:np.dtype=np.float64) -> Dict[int,float]:
+
+    '''
+    Measures the HitsDataset reading throughput as a function of the number of worker processes.
+    The csv binary cache is not used, so that every run parses the files.
+
+    INPUT:
+     - files:str or List[str], a glob pattern or a list of hits files, see HitsDataset
+     - max_workers:int, the maximum number of workers. If None, the number of cpu cores is used
+     - dtype:np.dtype, the hits floating point precision
+
+    OUTPUT:
+     - throughputs:Dict[int,float], the number of events read per second for each number of workers
+    '''
+
+    import os
+
+    if(max_workers is None):
+        max_workers = os.cpu_count()
+
+    throughputs = {}
+    for n_workers in range(1,max_workers+1):
+        dataset = HitsDataset(files,dtype=dtype,n_workers=n_workers,use_cache=False)
+        start = time.time()
+        hits = dataset.load()
+        throughputs[n_workers] = dataset.n_event/(time.time()-start)
+        del hits
+
+    print("# files = {}, # events = {}".format(len(dataset.files),dataset.n_event))
+    for n_workers, throughput in throughputs.items():
+        print("{} worker(s): {:.0f} events/s (x{:.2f})".format(n_workers,throughput,throughput/throughputs[1]))
+
+    return throughputs
+
+
+def compare_precision(hits:np.ndarray,
+                      voi:VolumeInterest,
+                      dtype:np.dtype=np.float32,
+                      fit_method:str='svd',
+                      angle_atol:float=1e-4,
+                      poca_atol:float=.5,
+                      max_voxel_fraction:float=1e-2) -> Dict[str,float]:
+
+    '''
+    Compares tracking and POCA outputs computed in reduced precision against float64, and checks that
+    deviations are within tolerances.
+
+    INPUT:
+     - hits:np.ndarray, the hits with shape (3,n_plane,n_event)
+     - voi:VolumeInterest, the volume of interest used for the POCA reconstruction
+     - dtype:np.dtype, the reduced precision
+     - fit_method:str, the track fitting method
+     - angle_atol:float, the tolerance on the angular features [rad]. Azimuthal angles are ill-defined for vertical tracks,
+     so their deviation is scaled by sin(theta), i.e. the deviation of the track direction along phi.
+     - poca_atol:float, the tolerance on the POCA points coordinates [mm]
+     - max_voxel_fraction:float, the maximum fraction of events whose triggered voxel differs
+
+    OUTPUT:
+     - deviations:Dict[str,float], the maximum absolute deviation of each angular feature [rad], of the POCA points [mm],
+     and the fraction of events whose triggered voxel differs
+    '''
+
+    tracks_64 = Tracking(hits=hits.astype(np.float64),fit_method=fit_method,dtype=np.float64)
+    tracks_32 = Tracking(hits=hits.astype(dtype),fit_method=fit_method,dtype=dtype)
+
+    deviations = {}
+    for feature in angular_features:
+        deviation = np.abs(tracks_64.get_feature(feature) - tracks_32.get_feature(feature).astype(np.float64))
+        if(feature.startswith('phi')):
+            deviation = np.minimum(deviation,2*np.pi-deviation)*np.sin(tracks_64.get_feature(feature.replace('phi','theta')))
+        deviations[feature] = np.nanmax(deviation)
+
+    # Same event selection in both precisions to compare POCA points
+    poca_64 = POCA(tracks=tracks_64,voi=voi)
+    poca_32 = POCA(tracks=tracks_32.select(poca_64.parallel_tracks_mask),voi=voi,dtheta_cut=-1.)
+    deviations['poca_points'] = np.abs(poca_64.poca_points - poca_32.poca_points).max()
+    deviations['triggered_voxel'] = np.mean(np.any(poca_64.triggered_vox_indices!=poca_32.triggered_vox_indices,axis=1))
+
+    for key, value in deviations.items():
+        print("{}: {:.2e}".format(key,value))
+
+    for feature in angular_features:
+        assert deviations[feature] <= angle_atol, "{} deviates by {:.2e} rad in {}".format(feature,deviations[feature],np.dtype(dtype).name)
+    assert deviations['poca_points'] <= poca_atol, "POCA points deviate by {:.2e} mm in {}".format(deviations['poca_points'],np.dtype(dtype).name)
+    assert deviations['triggered_voxel'] <= max_voxel_fraction, "{:.2e} of the events trigger another voxel in {}".format(deviations['triggered_voxel'],np.dtype(dtype).name)
+
+    return deviations
+
+
+def compute_triggered_voxels_indices_loop(poca_points:np.ndarray, voi:VolumeInterest) -> np.ndarray:
+
+    '''
+    Event by event voxel assignment, testing each POCA point against the edges of every voxel.
+    O(n_event x n_voxel), kept as a reference for POCA.compute_triggered_voxels_indices.
+
+    INPUT:
+     - poca_points:np.ndarray, the POCA points with shape (n_event,3)
+     - voi:VolumeInterest, the volume of interest
+
+    OUTPUT:
+     - indices:np.ndarray, the triggered voxels indices with shape (n_event,3), [-1,-1,-1] outside the voi
+    '''
+
+    indices = np.full((len(poca_points),3),-1)
+    for event, point in enumerate(poca_points):
+        mask = np.ones(voi.voxel_edges.shape[:3],dtype=bool)
+        for dim in [0,1,2]:
+            mask &= (point[dim] > voi.voxel_edges[:,:,:,0,dim]) & (point[dim] < voi.voxel_edges[:,:,:,1,dim])
+        triggered = np.transpose(mask.nonzero())
+        if(len(triggered)>0):
+            indices[event] = triggered[0]
+    return indices
+
+
+def benchmark_voxel_assignment(poca:POCA, n_event:Optional[int]=None) -> Dict[str,float]:
+
+    '''
+    Compares the vectorized voxel assignment against the event by event scan of all voxels, in terms of
+    computing time and results.
+
+    INPUT:
+     - poca:POCA, an instance of the POCA class
+     - n_event:int, the number of POCA points to use. If None, all points are used
+
+    OUTPUT:
+     - results:Dict[str,float], the computing times, speedup and number of events with a different voxel
+    '''
+
+    poca_points = poca.poca_points[:n_event]
+
+    start = time.time()
+    indices_loop = compute_triggered_voxels_indices_loop(poca_points,poca.voi)
+    time_loop = time.time()-start
+
+    start = time.time()
+    indices = poca.compute_triggered_voxels_indices(poca.voi,poca_points)
+    time_vectorized = time.time()-start
+
+    results = {'time_loop':time_loop,
+               'time_vectorized':time_vectorized,
+               'speedup':time_loop/time_vectorized,
+               'n_mismatch':int(np.any(indices!=indices_loop,axis=1).sum())}
+
+    print("# events = {}, # voxels = {}".format(len(poca_points),np.prod(poca.voi.n_vox_xyz)))
+    print("voxel scan loop: {:.3f} s".format(time_loop))
+    print("vectorized: {:.4f} s (x{:.0f})".format(time_vectorized,results['speedup']))
+    print("# events with a different voxel: {}".format(results['n_mismatch']))
+
+    return results
+
+
+def compare_approximate_quantiles(poca:POCA,
+                                  score_feature:Optional[np.ndarray]=None,
+                                  q:float=.5,
+                                  relative_error:float=.01,
+                                  score_range:tuple=(1e-4,np.pi)) -> Dict[str,float]:
+
+    '''
+    Compares the approximate per voxel quantiles computed from logarithmic histograms against exact np.quantile.
+
+    INPUT:
+     - poca:POCA, an instance of the POCA class
+     - score_feature:np.ndarray, the score of each event. If None, poca.tracks.dtheta is used
+     - q:float, the quantile to compare
+     - relative_error:float, the relative error bound of the approximate quantiles
+     - score_range:tuple, the positive range of the logarithmic bins
+
+    OUTPUT:
+     - results:Dict[str,float], the maximum relative error with respect to np.quantile, for voxels whose quantile
+     is interpolated between scores above score_range[0], along with the computing times and histogram memory per occupied voxel
+    '''
+
+    from functools import partial
+
+    if(score_feature is None):
+        score_feature = poca.tracks.dtheta
+
+    start = time.time()
+    exact, hit_per_voxel = poca.poca_reconstruction(score_feature,partial(np.quantile,q=q))
+    time_exact = time.time()-start
+
+    start = time.time()
+    accumulator = poca.compute_voxels_accumulator(score_feature,relative_error=relative_error,score_range=score_range)
+    approx = accumulator.quantile(q)
+    time_approx = time.time()-start
+
+    # Scores below score_range[0] have an absolute error bound instead
+    score_list = poca.compute_voxels_scores(score_feature)
+    n = score_list.counts[score_list.occupied]
+    lowest = score_list.sorted_scores[score_list.offsets[score_list.occupied]+np.floor(q*(n-1)).astype(int)]
+    in_range = lowest >= score_range[0]
+
+    occupied = np.unravel_index(score_list.occupied,tuple(poca.voi.n_vox_xyz))
+    with np.errstate(invalid='ignore',divide='ignore'):
+        error = np.abs(approx[occupied]-exact[occupied])[in_range]/exact[occupied][in_range]
+
+    results = {'max_relative_error':error.max(initial=0.),
+               'time_exact':time_exact,
+               'time_approx':time_approx,
+               'bytes_per_voxel':accumulator.histograms.itemsize*accumulator.n_bin}
+
+    print("# voxels with scores = {}, # bins = {}".format(len(n),accumulator.n_bin))
+    print("max relative error w.r.t. np.quantile: {:.2e} (bound {:.0e})".format(results['max_relative_error'],relative_error))
+    print("exact: {:.3f} s, approximate: {:.3f} s, {} bytes per occupied voxel".format(time_exact,time_approx,results['bytes_per_voxel']))
+    assert results['max_relative_error'] <= relative_error*(1+1e-9), "Approximate quantiles exceed the relative error bound w.r.t. np.quantile"
+
+    return results
+
+
+def compute_poca_points_solve(track_in:np.ndarray, track_out:np.ndarray, point_in:np.ndarray, point_out:np.ndarray) -> np.ndarray:
+
+    '''
+    POCA points computed by solving a 3x3 linear system per event, P1 + t1*V1 + t3*V3 = P2 + t2*V2 with V3 = V2 x V1.
+    Kept as a reference for the closed-form POCA.compute_poca_points.
+
+    INPUT:
+     - track_in:np.ndarray, track_out:np.ndarray, the incoming and outgoing tracks direction, with size (3,n_event)
+     - point_in:np.ndarray, point_out:np.ndarray, a point on the incoming and outgoing tracks, with size (3,n_event)
+
+    OUTPUT:
+     - poca_points:np.ndarray, the POCA points with shape (n_event,3)
+    '''
+
+    P1, P2 = np.transpose(point_in).astype(np.float64), np.transpose(point_out).astype(np.float64)
+    V1, V2 = np.transpose(track_in).astype(np.float64), np.transpose(track_out).astype(np.float64)
+    V3 = np.cross(V2,V1)
+
+    ts = np.linalg.solve(np.stack([V1,-V2,V3],axis=-1),(P2 - P1)[...,np.newaxis])[...,0]
+
+    Q1s, Q2s = P1 + ts[:,[0]]*V1, P2 + ts[:,[1]]*V2
+    return (Q2s-Q1s)/2+Q1s
+
+
+def benchmark_poca_points(poca:POCA, n_repeat:int=10) -> Dict[str,float]:
+
+    '''
+    Compares the closed-form POCA points computation against the per event 3x3 linear system solve,
+    in terms of computing time and results.
+
+    INPUT:
+     - poca:POCA, an instance of the POCA class
+     - n_repeat:int, the number of repetitions of each computation
+
+    OUTPUT:
+     - results:Dict[str,float], the computing times, speedup and maximum deviation of the POCA points
+    '''
+
+    inputs = {'track_in':poca.tracks.vectors[0], 'track_out':poca.tracks.vectors[1],
+              'point_in':poca.tracks.points[0], 'point_out':poca.tracks.points[1]}
+
+    start = time.time()
+    for _ in range(n_repeat):
+        poca_points_solve = compute_poca_points_solve(**inputs)
+    time_solve = (time.time()-start)/n_repeat
+
+    start = time.time()
+    for _ in range(n_repeat):
+        poca_points = poca.compute_poca_points(**inputs)
+    time_closed_form = (time.time()-start)/n_repeat
+
+    results = {'time_solve':time_solve,
+               'time_closed_form':time_closed_form,
+               'speedup':time_solve/time_closed_form,
+               'max_deviation':np.abs(poca_points - poca_points_solve).max()}
+
+    print("# events = {}".format(len(poca_points)))
+    print("3x3 solve: {:.4f} s".format(time_solve))
+    print("closed form: {:.4f} s (x{:.1f})".format(time_closed_form,results['speedup']))
+    print("max deviation: {:.2e} mm".format(results['max_deviation']))
+
+    return results
+
+
+def benchmark_hits_formats(filename:str, output_dir:str, scale:float=1e-3) -> Dict[str,Dict[str,float]]:
+
+    '''
+    Compares the csv, .npy and compact (see save_hits_compact) hits formats, in terms of file size,
+    reading time and precision.
+
+    INPUT:
+     - filename:str, the csv hits file
+     - output_dir:str, the directory where the .npy and compact files are written
+     - scale:float, the compact format quantization step in mm
+
+    OUTPUT:
+     - results:Dict[str,Dict[str,float]], the file size, reading time and maximum deviation of each format
+    '''
+
+    import os
+
+    start = time.time()
+    hits = get_hits_from_csv(filename,use_cache=False,verbose=False)
+    results = {'csv':{'size':os.path.getsize(filename),'time':time.time()-start,'max_deviation':0.}}
+
+    npy_filename = os.path.join(output_dir,'hits.npy')
+    np.save(npy_filename,hits)
+    start = time.time()
+    np.load(npy_filename)
+    results['npy'] = {'size':os.path.getsize(npy_filename),'time':time.time()-start,'max_deviation':0.}
+
+    for name, compress in [('compact',False),('compact_zlib',True)]:
+        compact_filename = os.path.join(output_dir,name+'.npz')
+        save_hits_compact(hits,compact_filename,scale=scale,compress=compress)
+        start = time.time()
+        compact_hits = load_hits_compact(compact_filename)
+        results[name] = {'size':os.path.getsize(compact_filename),'time':time.time()-start,
+                         'max_deviation':np.abs(compact_hits-hits).max()}
+
+    print("# events = {}".format(hits.shape[-1]))
+    for name, result in results.items():
+        print("{}: {:.1f} MB (x{:.1f} smaller than csv), read in {:.3f} s, max deviation {:.1e} mm".format(
+              name,result['size']/1e6,results['csv']['size']/result['size'],result['time'],result['max_deviation']))
+
+    return results
@@ -12,6 +12,15 @@ from reconstruction.poca import POCA
 
 def plot_POCA_event(poca:POCA,
                     event:int) -> None:
+
+    '''
+    Plots the hits, tracks and POCA point of an event.
+
+    INPUT:
+     - poca:POCA, an instance of the POCA class
+     - event:int, the index of the event in poca.tracks and poca.poca_points (parallel tracks excluded),
+     not in the Tracking instance POCA was given
+    '''
     
     import math
     fig,ax = plt.subplots(ncols=2)
@@ -0,0 +1,436 @@
+#Usual suspects
+import numpy as np
+from typing import Optional, Union, Dict, Tuple, Callable
+from copy import deepcopy
+
+# Muograph
+import sys
+sys.path.insert(1,'../muograph/')
+from volume.volume import VolumeInterest
+from reconstruction.voxel_scores import fast_reduce
+
+
+def log_bin_edges(relative_error:float, score_range:tuple=(1e-4,1.), signed:bool=False) -> np.ndarray:
+
+    '''
+    Logarithmic histogram bins such that any score within a bin [l,h] is within relative_error of 2*l*h/(l+h).
+
+    INPUT:
+     - relative_error:float, the relative error bound, between 0 and 1
+     - score_range:tuple, the positive range of the bins. Scores below score_range[0] fall in a first bin starting
+     at 0, where the error is bounded by score_range[0] instead. Scores above score_range[1] fall in the last bin.
+     - signed:bool, if True, the bins are mirrored for negative scores, e.g. for dtheta_x and dtheta_y, and scores
+     between -score_range[0] and score_range[0] fall in a single bin around 0
+
+    OUTPUT:
+     - bin_edges:np.ndarray, the bin edges
+    '''
+
+    assert (0 < relative_error < 1), 'relative_error must be between 0 and 1'
+    assert (0 < score_range[0] < score_range[1]), 'score_range must be positive'
+
+    # With h = g*l and g = (1+e)/(1-e), 2*l*h/(l+h) = (1+e)*l = (1-e)*h
+    gamma = (1+relative_error)/(1-relative_error)
+    n_bin = int(np.ceil(np.log(score_range[1]/score_range[0])/np.log(gamma)))
+    edges = score_range[0]*gamma**np.arange(n_bin+1)
+    if(signed):
+        return np.concatenate([-edges[::-1],edges])
+    return np.concatenate([[0.],edges])
+
+
+class VoxelAccumulator():
+
+    '''
+    Streaming per voxel statistics of the POCA points scores, bound to a VolumeInterest.
+
+    Chunks of POCA points are folded in one at a time, and only per voxel sufficient statistics are kept:
+    count, sum, sum of squares, min, max and a fixed-bin histogram of the scores. Histograms are only stored for
+    the occupied voxels, one row per occupied voxel in increasing voxel index (see occupied), so that memory is
+    O(n_voxel + n_occupied x n_bin) whatever the number of events. Two accumulators with the same voxels and histogram bins can be merged,
+    e.g. partial results computed from different files or processes. Merging is associative and commutative.
+
+    Statistics return arrays with shape (Nx,Ny,Nz), set to 0 for voxels without any event, as VoxelScores.
+    Quantiles are approximated from the histograms (see quantile). With relative_error, bins are logarithmic
+    (see log_bin_edges) and quantiles have a bounded relative error, as in the DDSketch quantile sketch.
+    '''
+
+    reductions = ('count','sum','mean','rms','var','std','min','max','median')
+
+    # Number of histograms whose cumulative sums are computed at once by quantile
+    block_size = 4096
+
+    def __init__(self,
+                 voi:VolumeInterest,
+                 bin_edges:Optional[np.ndarray]=None,
+                 score_range:Optional[tuple]=None,
+                 n_bin:int=64,
+                 relative_error:Optional[float]=None,
+                 signed:bool=False):
+
+        '''
+        INPUT:
+         - voi:VolumeInterest, an instance of the VolumeInterest class
+         - bin_edges:np.ndarray, the increasing edges of the scores histogram bins, with size (n_bin+1).
+         If None, n_bin uniform bins over score_range are used. Scores outside the bins are counted in the first/last bin.
+         - score_range:tuple, the scores range of the default bins, (0,0.2) rad by default, or (1e-4,pi) rad with relative_error
+         - n_bin:int, the number of default bins
+         - relative_error:float, if provided, logarithmic bins over score_range are used instead, such that quantiles
+         have a relative error below relative_error. score_range must then be positive, e.g. (1e-4,1.) rad for dtheta.
+         - signed:bool, with relative_error, whether the logarithmic bins are mirrored for negative scores (see log_bin_edges),
+         e.g. for dtheta_x and dtheta_y. Negative scores are rejected by unsigned logarithmic bins.
+        '''
+
+        self.voi = voi
+        self.n_vox_xyz = np.array(voi.n_vox_xyz)
+        self.relative_error = relative_error
+        if(relative_error is not None):
+            self.bin_edges = log_bin_edges(relative_error,(1e-4,np.pi) if score_range is None else score_range,signed=signed)
+        elif(bin_edges is None):
+            score_range = (0.,.2) if score_range is None else score_range
+            self.bin_edges = np.linspace(score_range[0],score_range[1],n_bin+1)
+        else:
+            self.bin_edges = np.asarray(bin_edges,dtype=np.float64)
+
+        n_voxel = int(np.prod(self.n_vox_xyz))
+        self.n_event = 0
+        self.counts = np.zeros(n_voxel,dtype=np.int64)
+        self.sums = np.zeros(n_voxel)
+        self.sums_sq = np.zeros(n_voxel)
+        self.mins = np.full(n_voxel,np.inf)
+        self.maxs = np.full(n_voxel,-np.inf)
+        self.histograms = np.zeros((0,len(self.bin_edges)-1),dtype=np.uint32)
+
+    @property
+    def n_bin(self) -> int:
+        return len(self.bin_edges)-1
+
+    @property
+    def occupied(self) -> np.ndarray:
+
+        '''
+        The flat indices of the voxels with at least one event, in increasing order, i.e. the voxels of the histograms rows.
+        '''
+
+        return np.flatnonzero(self.counts)
+
+    def expand_histograms(self, histograms:np.ndarray, occupied:np.ndarray, new_occupied:np.ndarray) -> np.ndarray:
+
+        '''
+        Returns the histograms rows of the voxels occupied, moved to the rows of new_occupied, a superset of occupied.
+        '''
+
+        if(len(new_occupied)==len(occupied)):
+            return histograms
+        expanded = np.zeros((len(new_occupied),self.n_bin),dtype=histograms.dtype)
+        expanded[np.searchsorted(new_occupied,occupied)] = histograms
+        return expanded
+
+    def fill(self, poca_points:np.ndarray, scores:np.ndarray) -> None:
+
+        '''
+        Folds a chunk of POCA points in.
+
+        INPUT:
+         - poca_points:np.ndarray, the POCA points with shape (n_event,3). Points outside the voi are ignored.
+         - scores:np.ndarray, the score of each POCA point, with size (n_event)
+        '''
+
+        self.fill_indices(self.voi.find_voxel_indices(poca_points),scores)
+
+    def fill_indices(self, voxel_indices:np.ndarray, scores:np.ndarray) -> None:
+
+        '''
+        Folds a chunk of events in, given their triggered voxel.
+
+        INPUT:
+         - voxel_indices:np.ndarray, the triggered voxel indices with shape (n_event,3), [-1,-1,-1] outside the voi
+         - scores:np.ndarray, the score of each event, with size (n_event)
+        '''
+
+        valid = np.all(voxel_indices>=0,axis=1)
+        flat_indices = np.ravel_multi_index(tuple(voxel_indices[valid].T),tuple(self.n_vox_xyz))
+        scores = np.asarray(scores,dtype=np.float64)[valid]
+
+        # Negative scores would all be counted in the first logarithmic bin, starting at 0
+        if((self.relative_error is not None) and (self.bin_edges[0]>=0) and np.any(scores<0)):
+            raise ValueError('Negative scores cannot be accumulated in positive logarithmic bins, use signed=True')
+
+        n_voxel = len(self.counts)
+        occupied = self.occupied
+
+        self.n_event += len(scores)
+        self.counts += np.bincount(flat_indices,minlength=n_voxel)
+        self.sums += np.bincount(flat_indices,weights=scores,minlength=n_voxel)
+        self.sums_sq += np.bincount(flat_indices,weights=scores**2,minlength=n_voxel)
+        np.minimum.at(self.mins,flat_indices,scores)
+        np.maximum.at(self.maxs,flat_indices,scores)
+
+        # Rows are added for the newly occupied voxels
+        new_occupied = self.occupied
+        self.histograms = self.expand_histograms(self.histograms,occupied,new_occupied)
+
+        bins = np.clip(np.searchsorted(self.bin_edges,scores,side='right')-1,0,self.n_bin-1)
+        np.add.at(self.histograms,(np.searchsorted(new_occupied,flat_indices),bins),1)
+
+    def merge(self, other:'VoxelAccumulator') -> 'VoxelAccumulator':
+
+        '''
+        Returns a new accumulator holding the statistics of both self and other.
+        '''
+
+        merged = self.snapshot()
+        merged += other
+        return merged
+
+    def __iadd__(self, other:'VoxelAccumulator') -> 'VoxelAccumulator':
+
+        assert np.array_equal(self.n_vox_xyz,other.n_vox_xyz), 'Accumulators must have the same voxels'
+        assert np.array_equal(self.bin_edges,other.bin_edges), 'Accumulators must have the same histogram bins'
+        assert self.relative_error==other.relative_error, 'Accumulators must have the same relative error'
+
+        occupied, other_occupied = self.occupied, other.occupied
+
+        self.n_event += other.n_event
+        self.counts += other.counts
+        self.sums += other.sums
+        self.sums_sq += other.sums_sq
+        np.minimum(self.mins,other.mins,out=self.mins)
+        np.maximum(self.maxs,other.maxs,out=self.maxs)
+
+        new_occupied = self.occupied
+        self.histograms = self.expand_histograms(self.histograms,occupied,new_occupied)
+        self.histograms[np.searchsorted(new_occupied,other_occupied)] += other.histograms
+        return self
+
+    def __add__(self, other:'VoxelAccumulator') -> 'VoxelAccumulator':
+        return self.merge(other)
+
+    def snapshot(self) -> 'VoxelAccumulator':
+
+        '''
+        Returns a copy of the current statistics, which is not affected by further fills.
+        '''
+
+        voi, self.voi = self.voi, None
+        copy = deepcopy(self)
+        self.voi = copy.voi = voi
+        return copy
+
+    def to_voxels(self, values:np.ndarray) -> np.ndarray:
+
+        '''
+        Reshapes per voxel values to (Nx,Ny,Nz), with 0 for empty voxels.
+        '''
+
+        return np.where(self.counts>0,values,0.).reshape(tuple(self.n_vox_xyz))
+
+    def count(self) -> np.ndarray:
+        return self.counts.reshape(tuple(self.n_vox_xyz)).astype(float)
+
+    def sum(self) -> np.ndarray:
+        return self.to_voxels(self.sums)
+
+    def mean(self) -> np.ndarray:
+        with np.errstate(invalid='ignore',divide='ignore'):
+            return self.to_voxels(self.sums/self.counts)
+
+    def rms(self) -> np.ndarray:
+        with np.errstate(invalid='ignore',divide='ignore'):
+            return self.to_voxels(np.sqrt(self.sums_sq/self.counts))
+
+    def var(self) -> np.ndarray:
+
+        # From the sums of scores and squared scores, less accurate than VoxelScores.var for large mean/std ratios
+        with np.errstate(invalid='ignore',divide='ignore'):
+            mean = self.sums/self.counts
+            return self.to_voxels(np.maximum(self.sums_sq/self.counts - mean**2,0.))
+
+    def std(self) -> np.ndarray:
+        return np.sqrt(self.var())
+
+    def min(self) -> np.ndarray:
+        return self.to_voxels(self.mins)
+
+    def max(self) -> np.ndarray:
+        return self.to_voxels(self.maxs)
+
+    def median(self) -> np.ndarray:
+        return self.quantile(q=.5)
+
+    def quantile(self, q:Union[float,np.ndarray]) -> np.ndarray:
+
+        '''
+        Approximate per voxel quantiles, interpolated linearly within the histogram bin containing the quantile.
+        Bins are bounded by the voxel min and max scores, so that the error is at most the width of that bin.
+
+        With logarithmic bins (relative_error), the floor(q*(n-1))-th and ceil(q*(n-1))-th smallest scores are each
+        approximated by 2*l*h/(l+h), with [l,h] their bin, within relative_error (see log_bin_edges). They are then
+        interpolated as np.quantile does, so that the result is within relative_error of np.quantile. With signed bins, if the two
+        scores have opposite signs, the error is instead bounded by relative_error times the largest of their absolute values.
+        Scores below score_range[0] in absolute value are approximated with an absolute error below score_range[0].
+
+        INPUT:
+         - q:float or np.ndarray, the quantile(s) to compute, between 0 and 1
+
+        OUTPUT:
+         - quantiles:np.ndarray, with shape (Nx,Ny,Nz), or (len(q),Nx,Ny,Nz) if q is an array
+        '''
+
+        q = np.asarray(q,dtype=np.float64)
+        if(q.ndim>0):
+            return np.stack([self.quantile(q_) for q_ in q])
+
+        # Cumulative histograms are only computed for a block of occupied voxels at a time
+        occupied = self.occupied
+        values = np.zeros(len(self.counts))
+        for start in range(0,len(occupied),self.block_size):
+            block = slice(start,start+self.block_size)
+            values[occupied[block]] = self.quantile_block(q,occupied[block],self.histograms[block])
+        return values.reshape(tuple(self.n_vox_xyz))
+
+    def quantile_block(self, q:float, occupied:np.ndarray, histograms:np.ndarray) -> np.ndarray:
+
+        '''
+        Approximate quantile q of the voxels occupied, given their histograms rows (see quantile).
+        '''
+
+        cumulative = np.cumsum(histograms,axis=1,dtype=np.int64)
+
+        def find_bin(rank:np.ndarray) -> Tuple[np.ndarray]:
+            # Bin containing the rank-th smallest score, its bounds, and the number of scores below it
+            bins = np.minimum((cumulative < rank[:,np.newaxis]).sum(axis=1),self.n_bin-1)
+            n_below = np.where(bins>0,cumulative[np.arange(len(occupied)),bins-1],0)
+            n_in = cumulative[np.arange(len(occupied)),bins] - n_below
+
+            low = np.maximum(self.bin_edges[bins],self.mins[occupied])
+            high = np.minimum(self.bin_edges[bins+1],self.maxs[occupied])
+            # Scores outside the bins are counted in the first/last bin
+            low = np.where(bins==0,self.mins[occupied],low)
+            high = np.where(bins==self.n_bin-1,self.maxs[occupied],high)
+            return low, high, n_below, n_in
+
+        if(self.relative_error is None):
+            rank = q*self.counts[occupied]
+            low, high, n_below, n_in = find_bin(rank)
+            fraction = np.clip((rank-n_below)/np.maximum(n_in,1),0.,1.)
+            return low + fraction*(high-low)
+        else:
+            # np.quantile linear interpolation between the order statistics around the virtual index q*(n-1)
+            index = q*(self.counts[occupied]-1)
+            index_below = np.floor(index)
+            gamma = index - index_below
+
+            def order_statistic(rank:np.ndarray) -> np.ndarray:
+                low, high, _, _ = find_bin(rank)
+                # Arithmetic center for the bin around 0
+                with np.errstate(invalid='ignore',divide='ignore'):
+                    return np.where(low*high>0,2*low*high/(low+high),(low+high)/2)
+
+            below = order_statistic(index_below+1)
+            above = order_statistic(np.minimum(index_below+2,self.counts[occupied]))
+            return np.where(gamma>=.5,above-(above-below)*(1-gamma),below+(above-below)*gamma)
+
+    def reduce(self, score_method:Union[str,Callable]) -> np.ndarray:
+
+        '''
+        Computes the final score of every voxel.
+
+        INPUT:
+         - score_method:str or Callable, either one of VoxelAccumulator.reductions, np.mean, np.median, np.var, np.std,
+         np.sum, or partial(np.quantile,q=...) and partial(np.percentile,q=...) for approximate quantiles
+
+        OUTPUT:
+         - final_voxel_scores:np.ndarray, the final scores with shape (Nx,Ny,Nz)
+        '''
+
+        if(isinstance(score_method,str)):
+            if(score_method not in self.reductions):
+                raise ValueError('score_method must be one of {}'.format(self.reductions))
+            return getattr(self,score_method)()
+
+        final_scores = fast_reduce(self,score_method)
+        if(final_scores is not None):
+            return final_scores
+
+        raise ValueError('{} cannot be computed from the per voxel statistics, score_method must be one of {}, '.format(score_method,self.reductions) +
+                         'np.mean, np.median, np.var, np.std, np.sum or partial(np.quantile,q=...)')
+
+    def rebin(self, factor:Union[int,Tuple[int]]) -> 'VoxelAccumulator':
+
+        '''
+        Returns the statistics of a coarser voxelization, whose voxels are blocks of factor voxels along each axis
+        (see VolumeInterest.rebin). All statistics are block-aggregated, without going back to the events.
+
+        INPUT:
+         - factor:int or Tuple[int], the number of voxels merged along each axis, which must divide n_vox_xyz
+
+        OUTPUT:
+         - accumulator:VoxelAccumulator, the coarser statistics, bound to the coarser VolumeInterest
+        '''
+
+        voi = self.voi.rebin(factor)
+        factor = np.broadcast_to(np.asarray(factor,dtype=int),(3,))
+
+        def aggregate(values:np.ndarray, reduction:np.ufunc) -> np.ndarray:
+            # (Nx,Ny,Nz,...) -> (Nx/fx,fx,Ny/fy,fy,Nz/fz,fz,...), reduced over the blocks
+            blocks = values.reshape(tuple(np.stack([voi.n_vox_xyz,factor],axis=-1).ravel())+values.shape[1:])
+            return reduction.reduce(blocks,axis=(1,3,5)).reshape((voi.n_vox,)+values.shape[1:])
+
+        accumulator = VoxelAccumulator(voi=voi,bin_edges=self.bin_edges)
+        accumulator.relative_error = self.relative_error
+        accumulator.n_event = self.n_event
+        accumulator.counts = aggregate(self.counts,np.add)
+        accumulator.sums = aggregate(self.sums,np.add)
+        accumulator.sums_sq = aggregate(self.sums_sq,np.add)
+        accumulator.mins = aggregate(self.mins,np.minimum)
+        accumulator.maxs = aggregate(self.maxs,np.maximum)
+
+        # Histograms rows of the occupied voxels are summed per coarser voxel, ordered as the coarser occupied voxels
+        occupied = self.occupied
+        coarse = np.ravel_multi_index(tuple(np.array(np.unravel_index(occupied,tuple(self.n_vox_xyz)))//factor[:,np.newaxis]),
+                                      tuple(voi.n_vox_xyz))
+        order = np.argsort(coarse,kind='stable')
+        starts = np.flatnonzero(np.diff(coarse[order],prepend=-1))
+        if(len(occupied)>0):
+            accumulator.histograms = np.add.reduceat(self.histograms[order],starts,axis=0)
+        return accumulator
+
+    def save(self, filename:str) -> None:
+
+        '''
+        Saves the statistics in a .npz file, e.g. to merge results computed on different machines.
+        '''
+
+        np.savez(filename,**self.get_state())
+
+    def get_state(self) -> Dict[str,np.ndarray]:
+
+        return {'n_vox_xyz':self.n_vox_xyz, 'bin_edges':self.bin_edges, 'n_event':self.n_event,
+                'relative_error':np.nan if self.relative_error is None else self.relative_error,
+                'counts':self.counts, 'sums':self.sums, 'sums_sq':self.sums_sq,
+                'mins':self.mins, 'maxs':self.maxs, 'histograms':self.histograms}
+
+    @classmethod
+    def load(cls, filename:str, voi:VolumeInterest) -> 'VoxelAccumulator':
+
+        '''
+        Loads statistics saved with save.
+
+        INPUT:
+         - filename:str, the .npz file
+         - voi:VolumeInterest, the volume of interest the statistics were computed with
+        '''
+
+        state = dict(np.load(filename))
+        assert np.array_equal(state['n_vox_xyz'],voi.n_vox_xyz), 'voi does not match the saved accumulator voxels'
+
+        accumulator = cls(voi=voi,bin_edges=state['bin_edges'])
+        if(np.isfinite(state['relative_error'])):
+            accumulator.relative_error = float(state['relative_error'])
+        for key in ['counts','sums','sums_sq','mins','maxs','histograms']:
+            setattr(accumulator,key,state[key])
+        # Histograms saved for every voxel
+        if(len(accumulator.histograms)==len(accumulator.counts)):
+            accumulator.histograms = accumulator.histograms[accumulator.occupied]
+        accumulator.n_event = int(state['n_event'])
+        return accumulator
@@ -1,6 +1,6 @@
 #Usual suspects
 import numpy as np
-from typing import Tuple, Optional, List, Union
+from typing import Tuple, Optional, List, Union, Dict, Iterable
 import math
 from copy import deepcopy
 NoneType = type(None)
@@ -12,59 +12,159 @@ import sys
 sys.path.insert(1,'../muograph/')
 from tracking.tracking import Tracking
 from volume.volume import VolumeInterest
+from reconstruction.voxel_scores import VoxelScores, group_by_voxel
+from reconstruction.accumulator import VoxelAccumulator
+from utils.utils import iter_hits
+from utils.arrays import append_to_buffer
 
 
 class POCA():
     
-    def __init__(self, tracks:Tracking, voi:VolumeInterest, dtheta_cut:float=0.005):
+    def __init__(self, tracks:Tracking, voi:VolumeInterest, dtheta_cut:float=0.005, dtype:Optional[np.dtype]=None):
+
+        '''
+        INPUT:
+         - tracks:Tracking, an instance of the Tracking class
+         - voi:VolumeInterest, an instance of the VolumeInterest class
+         - dtheta_cut:float, tracks with scattering angle below dtheta_cut [rad] are considered parallel and rejected
+         - dtype:np.dtype, the POCA points floating point precision. If None, the tracks precision is used.
+        '''
+
+        self.dtype = tracks.dtype if dtype is None else np.dtype(dtype)
         
-        self.all_tracks = deepcopy(tracks)
+        # tracks is not modified, selections share its arrays
+        self.all_tracks = tracks
         self.voi = voi
         # Compute parallel tracks mask
         self.dtheta_cut = dtheta_cut
         self.parallel_tracks_mask = self.compute_parallel_tracks_mask()
         
         # Remove parallel events
-        tracks.apply_mask(self.parallel_tracks_mask)
-        self.tracks = tracks
+        self.tracks = tracks.select(self.parallel_tracks_mask)
         
-        # Compute POCA points
-        self.poca_points = self.compute_poca_points(track_in = self.tracks.vectors[0],
-                                                    track_out = self.tracks.vectors[1],
-                                                   point_in = self.tracks.points[0],
-                                                   point_out = self.tracks.points[1])
+        # Compute POCA points, and distance of closest approach between incoming and outgoing tracks
+        self.poca_points, self.poca_distances = self.compute_poca_points(track_in = self.tracks.vectors[0],
+                                                                         track_out = self.tracks.vectors[1],
+                                                                         point_in = self.tracks.points[0],
+                                                                         point_out = self.tracks.points[1],
+                                                                         return_distance = True)
 
         # Mask POCA points within volume of interest
         self.mask_in_voi = self.compute_mask_in_voi(self.voi)
         self.poca_points_in = self.poca_points[self.mask_in_voi]
 
-        # Compute normalized poca points
+        # Compute normalized poca points, and normalization range
+        self.norm_range = None
         self.norm_poca_points = self.compute_normalized_poca_positions()
         
         # Compute triggered voxels indices
         self.triggered_vox_indices = self.compute_triggered_voxels_indices(self.voi)
+
+        # Events grouping by voxel, reused as long as the mask does not change
+        self._voxel_grouping = None
+
+        # Multi-resolution voxel statistics, see build_voxel_pyramid
+        self._voxel_pyramid = None
+
+        # Storage with spare capacity of the per event arrays, see extend
+        self._buffers = {}
         
 
-    def compute_parallel_tracks_mask(self) -> np.ndarray:
+    def extend(self, new_hits:np.ndarray) -> None:
+
+        '''
+        Appends new events, e.g. when new hit files arrive during an exposure. The new events are added to
+        self.all_tracks (see Tracking.extend), and POCA points and triggered voxels are only computed for them.
+        Arrays are stored with spare capacity, doubled when full, so that the cost of an update is amortized O(new events).
+
+        INPUT:
+         - new_hits:np.ndarray, the hits of the new events, with shape (3,n_plane,n_new)
+        '''
+
+        n_old = self.all_tracks.n_event
+        self.all_tracks.extend(new_hits)
+        new_indices = np.arange(n_old,self.all_tracks.n_event)
+        new_tracks = self.all_tracks.select(new_indices)
+
+        # Remove parallel events
+        new_mask = self.compute_parallel_tracks_mask(new_tracks)
+        self.append_events('parallel_tracks_mask',new_mask)
+        self.tracks.extend_selection(self.all_tracks,new_indices[new_mask])
+        new_tracks = new_tracks.select(new_mask)
+
+        # Compute POCA points
+        new_poca_points, new_distances = self.compute_poca_points(track_in = new_tracks.vectors[0],
+                                                                  track_out = new_tracks.vectors[1],
+                                                                  point_in = new_tracks.points[0],
+                                                                  point_out = new_tracks.points[1],
+                                                                  return_distance = True)
+        self.append_events('poca_points',new_poca_points)
+        self.append_events('poca_distances',new_distances)
+
+        # Mask POCA points within volume of interest
+        new_mask_in_voi = self.compute_mask_in_voi(self.voi,new_poca_points)
+        self.append_events('mask_in_voi',new_mask_in_voi)
+        self.append_events('poca_points_in',new_poca_points[new_mask_in_voi])
+
+        # Normalized poca points, only renormalized if the new points extend the normalization range
+        new_points_in = new_poca_points[new_mask_in_voi]
+        if(len(new_points_in)>0):
+            x_range = (np.min(new_points_in[:,0]), np.max(new_points_in[:,0]))
+            if(self.norm_range is not None):
+                x_range = (min(x_range[0],self.norm_range[0]), max(x_range[1],self.norm_range[1]))
+            if(x_range==self.norm_range):
+                self.append_events('norm_poca_points',self.compute_normalized_poca_positions(new_points_in,x_range))
+            else:
+                self.norm_range = x_range
+                self.norm_poca_points = self.compute_normalized_poca_positions(self.poca_points_in,x_range)
+                self._buffers.pop('norm_poca_points',None)
+
+        # Compute triggered voxels indices
+        self.append_events('triggered_vox_indices',self.compute_triggered_voxels_indices(self.voi,new_poca_points))
+        self._voxel_grouping, self._voxel_pyramid = None, None
+
+    def __getstate__(self) -> Dict:
+
+        # Arrays are pickled without their spare capacity
+        state = dict(self.__dict__)
+        state['_buffers'] = {}
+        return state
+
+    def append_events(self, name:str, new_values:np.ndarray) -> None:
+
+        '''
+        Appends new_values to the per event array name, in amortized O(new events) (see append_to_buffer).
+        '''
+
+        array, self._buffers[name] = append_to_buffer(getattr(self,name),new_values,self._buffers.get(name),axis=0)
+        setattr(self,name,array)
+
+
+    def compute_parallel_tracks_mask(self, tracks:Optional[Tracking]=None) -> np.ndarray:
 
         '''
         Create a mask based on a scattering angle.
 
         INPUT:
          - dtheta_cut:float, the cut on scattering angle
-         - tracks:Tracking, an instance of the Tracking class
+         - tracks:Tracking, an instance of the Tracking class. If None, self.all_tracks is used.
 
         OUTPUT:
          - mask:np.ndarray, a boolean mask with size (tracks.n_event)
         '''
 
-        return self.all_tracks.dtheta > self.dtheta_cut
+        if(tracks is None):
+            tracks = self.all_tracks
+
+        return tracks.dtheta > self.dtheta_cut
     
     def compute_poca_points(self,
                             track_in:np.ndarray,
                             track_out:np.ndarray,
                             point_in:np.ndarray,
-                            point_out:np.ndarray,) -> np.ndarray:
+                            point_out:np.ndarray,
+                            return_distance:bool=False,
+                            chunk_size:int=100000) -> Union[np.ndarray,Tuple[np.ndarray]]:
         '''
         INPUT: 
 
@@ -72,162 +172,189 @@ class POCA():
         - track_out:np.ndarray, outgoing reconstructed track, with size (3,Nevent)
         - point_in:np.ndarray, a point on V1, with size (3,Nevent)
         - point_out:np.ndarray, a point on V2, with size (3,Nevent)
+        - return_distance:bool, if True, the distance of closest approach between the tracks is also returned
+        - chunk_size:int, the number of events processed at once
 
         OUTPUT: 
-        - POCA_points:np.ndarray,  with size (3,Nevent)
+        - POCA_points:np.ndarray,  with size (Nevent,3)
+        - distance:np.ndarray, the distance of closest approach in mm, with size (Nevent). Only if return_distance.
 
         Given 2 lines V1, V2 aka incoming and outgoing tracks with parametric equation:
         L1 = P1 + t*V1
 
-        1- A segment of shortest length between two 3D lines L1 L2 is perpendicular to both lines 
-        (if L1 L2 are neither parallele or in the same plane). One must compute V3, vector perpendicular 
-        to L1 and L2
+        1- The segment of shortest length Q1-Q2 between two 3D lines L1 L2, with Q1,2 = P1,2 +t1,2*V1,2,
+        is perpendicular to both lines: (Q1-Q2).V1 = 0 and (Q1-Q2).V2 = 0
 
-        2- Search for points where L3 = P1 + t1*V1 +t3*V3 crosses L2. One must find t1 and t2 for which:
-        L3 = P1 + t1*V1 +t3*V3 = P2 + t2*V2
+        2- With W = P1-P2, a = V1.V1, b = V1.V2, c = V2.V2, d = V1.W, e = V2.W, this gives:
+        t1 = (b*e - c*d) / (a*c - b^2) and t2 = (a*e - b*d) / (a*c - b^2)
 
-        3- Then POCA location M is the middle of the segment Q1-Q2 where Q1,2 = P1,2 +t1,2*V1,2
+        3- Then POCA location M is the middle of the segment Q1-Q2
 
+        When the tracks are (nearly) parallel, a*c - b^2 vanishes and the closest points are not defined.
+        Q1 is then taken as P1, and Q2 as its projection on L2.
         '''
 
-        P1, P2 = np.transpose(point_in), np.transpose(point_out)
-        V1, V2 = np.transpose(track_in), np.transpose(track_out)
-        V3 = np.cross(V2,V1)
-
-        RES = P2 - P1
-        LES = np.transpose(np.stack([V1,-V2,V3]),(1,2,0))
-
-        ts = np.linalg.solve(LES,RES)
-
-        t1 = np.stack([ts[:,0],ts[:,0],ts[:,0]],-1)
-        t2 = np.stack([ts[:,1],ts[:,1],ts[:,1]],-1)
-
-        Q1s,Q2s = P1+t1*V1, P2+t2*V2
-        M = (Q2s-Q1s)/2+Q1s
-
-        return M
-
-    def compute_mask_in_voi(self, voi:VolumeInterest) -> np.ndarray:
+        n_event = track_in.shape[-1]
+        poca_points = np.empty((n_event,3),dtype=self.dtype)
+        distance = np.empty(n_event,dtype=self.dtype)
+
+        # Computed in float64 whatever the tracks precision, as nearly parallel tracks make the problem ill-conditioned
+        for start in range(0,n_event,chunk_size):
+            chunk = slice(start,start+chunk_size)
+            P1, V1 = point_in[:,chunk].astype(np.float64), track_in[:,chunk].astype(np.float64)
+            P2, V2 = point_out[:,chunk].astype(np.float64), track_out[:,chunk].astype(np.float64)
+
+            W = P1 - P2
+            a, b, c = np.einsum('ij,ij->j',V1,V1), np.einsum('ij,ij->j',V1,V2), np.einsum('ij,ij->j',V2,V2)
+            d, e = np.einsum('ij,ij->j',V1,W), np.einsum('ij,ij->j',V2,W)
+            denominator = a*c - b*b
+
+            parallel = denominator <= 1e-12*a*c
+            denominator[parallel] = 1.
+            t1 = np.where(parallel,0.,(b*e - c*d)/denominator)
+            t2 = np.where(parallel,e/c,(a*e - b*d)/denominator)
+
+            # Q1 and Q2, written in place of P1 and P2
+            P1 += t1*V1
+            P2 += t2*V2
+            poca_points[chunk] = ((P1+P2)/2).T
+            distance[chunk] = np.sqrt(np.einsum('ij,ij->j',P1-P2,P1-P2))
+
+        if(return_distance):
+            return poca_points, distance
+        return poca_points
+
+    def compute_mask_in_voi(self, voi:VolumeInterest, poca_points:Optional[np.ndarray]=None) -> np.ndarray:
         
-        x,y,z = self.poca_points[:,0],self.poca_points[:,1],self.poca_points[:,2]
+        if(poca_points is None):
+            poca_points = self.poca_points
+
+        x,y,z = poca_points[:,0],poca_points[:,1],poca_points[:,2]
         mask = np.ones_like(x,dtype=bool)
         for coord, voi_min, voi_max in zip((x,y,z),voi.xyz_min,voi.xyz_max):
             mask = mask & (coord>voi_min) & (coord<voi_max)
         return mask
 
-    def compute_triggered_voxels_indices(self, voi:VolumeInterest):
+    def compute_triggered_voxels_indices(self, voi:VolumeInterest, poca_points:Optional[np.ndarray]=None):
 
         '''
         Compute the indices of triggered voxels. Given a POCA point with coordinnate x,y,z, the triggered voxel is the one which contains x,y and z.
         
         INPUT:
          - voi:VolumeInterest, an instance of the VolumeInterest class
+         - poca_points:np.ndarray, the POCA points with shape (n_event,3). If None, self.poca_points is used.
         OUTPUT:
-         - indices:np.array, the array containing the triggered voxels indices as integers, with size (self.tracks.n_event, 3)
+         - indices:np.array, the array containing the triggered voxels indices as integers, with size (n_event, 3)
+
+        Voxel indices are computed for all events at once (see VolumeInterest.find_voxel_indices).
+        Points lying outside the VOI, or exactly on a voxel edge, get indices [-1,-1,-1].
         '''
+        if(poca_points is None):
+            poca_points = self.poca_points
+
         print("Scattering location computation in progress ...")
-        def compute_triggered_vox_indices_event(event):
-            '''
-            Compute the triggered voxel indices for a given event.
-            '''        
-            x, y, z = self.poca_points[:, 0], self.poca_points[:, 1], self.poca_points[:, 2]
-            mask = np.ones_like(voi.voxel_edges[:, :, :, 0, 0], dtype=bool)
-    
-            for coord, dim in zip([x, y, z], [0, 1, 2]):
-                mask = mask & (coord[event] > voi.voxel_edges[:, :, :, 0, dim]) & (coord[event] < voi.voxel_edges[:, :, :, 1, dim])
-    
-            indices = np.transpose((mask == True).nonzero()) 
-            
-            return indices
-    
-        from joblib import Parallel, delayed
-        from fastprogress import progress_bar
-        indices_list=[]
-        for i in progress_bar(range(self.tracks.n_event)):
-            indices_list.append(compute_triggered_vox_indices_event(i))
-        # indices_list = Parallel(n_jobs=-1)(delayed(compute_triggered_vox_indices_event)(i) for i in progress_bar(range(self.tracks.n_event)))   
-    
-        # Replace empty arrays with [-1, -1, -1]
-        def handle_empty_arrays(arr):
-            return arr if arr.size > 0 else np.array([[-1, -1, -1]])
-    
-        filled_arrays = [handle_empty_arrays(arr) for arr in indices_list]
+        indices = voi.find_voxel_indices(poca_points)
         print("Scattering location computation done")
-        return np.vstack(filled_arrays)
+        return indices
 
     
 
+    def get_voxel_grouping(self, mask:Union[np.ndarray, NoneType] = None) -> Tuple[np.ndarray]:
+
+        '''
+        Groups the events by triggered voxel (see group_by_voxel). The grouping is cached and reused
+        as long as the same mask is provided.
+
+        INPUT:
+         - mask:np.ndarray, a boolean mask of the events to use. If None, all events are used
+        OUTPUT:
+         - event_order:np.ndarray, offsets:np.ndarray, the events grouping
+        '''
+
+        if(self._voxel_grouping is not None):
+            cached_mask, event_order, offsets = self._voxel_grouping
+            if((mask is None) & (cached_mask is None)):
+                return event_order, offsets
+            if((mask is not None) & (cached_mask is not None)):
+                if(np.array_equal(mask,cached_mask)):
+                    return event_order, offsets
+
+        # reject events outside the voi (a.k.a triggered indices = [-1,-1,-1])
+        event_order, offsets = group_by_voxel(voxel_indices=self.triggered_vox_indices,
+                                              n_vox_xyz=self.voi.n_vox_xyz,
+                                              mask=mask)
+        self._voxel_grouping = (None if mask is None else np.array(mask,dtype=bool), event_order, offsets)
+
+        return event_order, offsets
+
     def compute_voxels_scores(self, 
                               score_feature:np.ndarray,
-                              mask:Union[np.ndarray, NoneType] = None) -> List[List[List[float]]]:
+                              mask:Union[np.ndarray, NoneType] = None) -> VoxelScores:
 
         '''
         Associate a score to each triggered voxel according to the choice of score_feature.
+        Events are sorted once by voxel, so that the scores of each voxel are contiguous (see VoxelScores).
     
         INPUT:
-         - score_feature:np.ndarray, the scores to be appent to the voxel list
+         - score_feature:np.ndarray, the score of each event
+         - mask:np.ndarray, a boolean mask of the events to use. If None, all events are used
         OUTPUT:
-         - score_list:List[List[List[float]]], the list containg the scores
+         - score_list:VoxelScores, the scores grouped by voxel
         '''
-    
-        # Create empty score list 
-        score_list = [[[[] for _ in range(self.voi.n_vox_xyz[2])] for _ in range(self.voi.n_vox_xyz[1])] for _ in range(self.voi.n_vox_xyz[0])]
 
-        # reject events outside the voi (a.k.a triggered indices = [-1,-1,-1])
-        if mask is None:
-            mask = (self.triggered_vox_indices.sum(axis=1) != -3)
-        else:
-            mask = mask & (self.triggered_vox_indices.sum(axis=1) != -3)
+        event_order, offsets = self.get_voxel_grouping(mask=mask)
 
-        
-        # Get the indices where total_mask is True
-        mask_indices = np.where(mask)[0]
-        
-        # Extract the relevant indices and scores
-        ix, iy, iz = self.triggered_vox_indices[mask_indices, 0], self.triggered_vox_indices[mask_indices, 1], self.triggered_vox_indices[mask_indices, 2]
-        selected_scores = score_feature[mask_indices]
-        
-        # Update the score_list using list comprehensions
-        for i, (x, y, z, score) in enumerate(zip(ix, iy, iz, selected_scores)):
-            score_list[x][y][z].append(score)
-        
-        return score_list
+        return VoxelScores(scores=score_feature,event_order=event_order,offsets=offsets,n_vox_xyz=self.voi.n_vox_xyz)
         
 
     def compute_final_voxels_score(self,
-                                   score_list:List[List[List[float]]],
-                                   score_method:functools.partial) -> np.array:
+                                   score_list:VoxelScores,
+                                   score_method:Union[functools.partial,str]) -> Tuple[np.ndarray]:
         '''
         Computes the final score of every voxel, using score_method as input.
     
-        score_method can be mean, variance, quartile, etc...
+        score_method can be mean, variance, quartile, etc... (see VoxelScores.reduce)
     
         INPUT:
-         - score_list:List[List[List[float]]], the scores
+         - score_list:VoxelScores, the scores grouped by voxel
          - score_method:functools.partial, the method to be used to compute the final scores from scores
+        OUTPUT:
+         - final_voxel_scores:np.ndarray, the final score of each voxel, with shape (Nx,Ny,Nz)
+         - hit_per_voxel:np.ndarray, the number of POCA points in each voxel, with shape (Nx,Ny,Nz)
         '''
-        from fastprogress import progress_bar
-        Nx, Ny, Nz = self.voi.n_vox_xyz[0], self.voi.n_vox_xyz[1], self.voi.n_vox_xyz[2]
-        final_voxel_scores, hit_per_voxel = np.zeros((Nx,Ny,Nz)), np.zeros((Nx,Ny,Nz)) 
-    
-        #loop over every voxels
-        for i in progress_bar(range(Nx)):
-            for j in range(Ny):
-                for k in range(Nz):
-    
-                    if(score_list[i][j][k]!=[]):
-                        hit_per_voxel[i,j,k] += len(score_list[i][j][k])
-                        final_voxel_scores[i,j,k] = score_method(score_list[i][j][k])
-                      
-        return final_voxel_scores, hit_per_voxel
+
+        return score_list.reduce(score_method), score_list.count()
 
     def poca_reconstruction(self,
                             score_feature:np.ndarray,
-                            score_method:functools.partial = partial(np.quantile,q=.5),
-                            mask:Union[np.ndarray, NoneType] = None) -> Tuple[np.ndarray]:
+                            score_method:Union[functools.partial,str] = partial(np.quantile,q=.5),
+                            mask:Union[np.ndarray, NoneType] = None,
+                            relative_error:Optional[float] = None,
+                            score_range:Optional[tuple] = None,
+                            rebin:Optional[Union[int,Tuple[int]]] = None) -> Tuple[np.ndarray]:
         '''
         Proceed to POCA algorithm reconstruction. Given a voxelized volume and a collection of poca points, computes a final score per voxel given score_feature (the score attributed to each POCA point) and score_method (the function used to assign a final score based on a collection of score_feature of a single voxel).
+        Quantiles, mean, rms, variance and standard deviation are computed with segmented reductions over all voxels at once, other score methods are called voxel by voxel (see VoxelScores.reduce).
+
+        If relative_error is provided, quantile score methods are approximated from per voxel logarithmic histograms over score_range, mirrored for signed scores,
+        with bounded memory per voxel and relative error below relative_error (see VoxelAccumulator).
+
+        If rebin is provided, the final scores are computed on a coarser voxelization made of blocks of rebin voxels along each axis,
+        from the voxel pyramid of score_feature (see build_voxel_pyramid). The pyramid is built once, and coarser maps are then
+        block-aggregated from the finest one, without going back to the events. Quantiles are then approximated from logarithmic
+        histograms, with relative error below relative_error (1% if None), and score_method must be supported by VoxelAccumulator.reduce.
         '''
+
+        if(rebin is not None):
+            self.build_voxel_pyramid(score_feature=score_feature,mask=mask,
+                                     relative_error=.01 if relative_error is None else relative_error,score_range=score_range)
+            accumulator = self.get_voxel_pyramid_level(rebin)
+            return accumulator.reduce(score_method), accumulator.count()
+
+        if(relative_error is not None):
+            accumulator = self.compute_voxels_accumulator(score_feature=score_feature,mask=mask,
+                                                          relative_error=relative_error,score_range=score_range)
+            return accumulator.reduce(score_method), accumulator.count()
     
         score_list = self.compute_voxels_scores(score_feature=score_feature,mask=mask)
         final_scores, hit_per_voxel = self.compute_final_voxels_score(score_list=score_list,
@@ -235,18 +362,140 @@ class POCA():
     
         return final_scores, hit_per_voxel
 
-    def compute_normalized_poca_positions(self) -> np.array:
+    def compute_voxels_accumulator(self,
+                                   score_feature:np.ndarray,
+                                   mask:Union[np.ndarray, NoneType] = None,
+                                   **kwargs) -> VoxelAccumulator:
+        '''
+        Folds the events scores into a VoxelAccumulator, with bounded memory per voxel.
+
+        INPUT:
+         - score_feature:np.ndarray, the score of each event
+         - mask:np.ndarray, a boolean mask of the events to use. If None, all events are used
+         - kwargs: the VoxelAccumulator histogram bins arguments, e.g. relative_error and score_range.
+         Logarithmic bins are signed if any score is negative, unless signed is provided.
+        OUTPUT:
+         - accumulator:VoxelAccumulator, the per voxel statistics
+        '''
+
+        scores = score_feature if mask is None else score_feature[mask]
+        if(kwargs.get('relative_error') is not None):
+            kwargs.setdefault('signed',bool(np.any(scores<0)))
+
+        accumulator = VoxelAccumulator(voi=self.voi,**kwargs)
+        voxel_indices = self.triggered_vox_indices if mask is None else self.triggered_vox_indices[mask]
+        accumulator.fill_indices(voxel_indices,scores)
+        return accumulator
+
+    def build_voxel_pyramid(self,
+                            score_feature:np.ndarray,
+                            mask:Union[np.ndarray, NoneType] = None,
+                            **kwargs) -> Dict[Tuple[int],VoxelAccumulator]:
+        '''
+        Builds the mergeable statistics of score_feature at the finest voxelization, self.voi, from which coarser
+        voxelizations are derived by block-aggregation (see get_voxel_pyramid_level). The pyramid is cached, and only
+        rebuilt if score_feature, mask or the histogram bins arguments change.
+
+        INPUT:
+         - score_feature:np.ndarray, the score of each event
+         - mask:np.ndarray, a boolean mask of the events to use. If None, all events are used
+         - kwargs: the VoxelAccumulator histogram bins arguments, e.g. relative_error and score_range
+        OUTPUT:
+         - pyramid:Dict[Tuple[int],VoxelAccumulator], the statistics per rebinning factor, starting with (1,1,1)
+        '''
+
+        kwargs = {key:value for key, value in kwargs.items() if value is not None}
+
+        if(self._voxel_pyramid is not None):
+            cached_feature, cached_mask, cached_kwargs, pyramid = self._voxel_pyramid
+            same_mask = (mask is None) & (cached_mask is None)
+            if((mask is not None) & (cached_mask is not None)):
+                same_mask = np.array_equal(mask,cached_mask)
+            if((cached_feature is score_feature) & same_mask & (cached_kwargs==kwargs)):
+                return pyramid
+
+        pyramid = {(1,1,1):self.compute_voxels_accumulator(score_feature=score_feature,mask=mask,**kwargs)}
+        self._voxel_pyramid = (score_feature, None if mask is None else np.array(mask,dtype=bool), kwargs, pyramid)
+        return pyramid
+
+    def get_voxel_pyramid_level(self, rebin:Union[int,Tuple[int]]) -> VoxelAccumulator:
+        '''
+        Returns the statistics of the voxel pyramid (see build_voxel_pyramid) with voxels made of blocks of rebin voxels along each axis.
+        Levels are block-aggregated from the finest level on first request, and cached.
+
+        INPUT:
+         - rebin:int or Tuple[int], the number of voxels merged along each axis, which must divide self.voi.n_vox_xyz
+        OUTPUT:
+         - accumulator:VoxelAccumulator, the statistics, bound to the coarser VolumeInterest (accumulator.voi)
+        '''
+
+        assert self._voxel_pyramid is not None, 'The voxel pyramid must be built first, see build_voxel_pyramid'
+        pyramid = self._voxel_pyramid[-1]
+
+        rebin = tuple(int(f) for f in np.broadcast_to(rebin,(3,)))
+        if(rebin not in pyramid):
+            # Aggregate from the coarsest cached level the requested level is a multiple of
+            finer = max([level for level in pyramid if all(f%l==0 for f, l in zip(rebin,level))],key=np.prod)
+            pyramid[rebin] = pyramid[finer].rebin(tuple(f//l for f, l in zip(rebin,finer)))
+        return pyramid[rebin]
+
+    def poca_multi_reconstruction(self,
+                                  score_features:Union[List[str],Dict[str,np.ndarray]] = ['dtheta'],
+                                  score_methods:Union[List[str],Dict[str,Union[functools.partial,str]]] = ['median'],
+                                  mask:Union[np.ndarray, NoneType] = None) -> Dict[str,np.ndarray]:
+        '''
+        Computes several final scores per voxel, for several score features, from a single grouping of the events by voxel.
+
+        INPUT:
+         - score_features:List[str] or Dict[str,np.ndarray], either names of self.tracks features (e.g. 'dtheta', 'dtheta_x'),
+         or a dict of named scores with size (n_event)
+         - score_methods:List[str] or Dict[str,functools.partial], either names of VoxelScores.reductions, or a dict of named
+         score methods (see VoxelScores.reduce)
+         - mask:np.ndarray, a boolean mask of the events to use. If None, all events are used
+        OUTPUT:
+         - voxel_maps:Dict[str,np.ndarray], the final scores with shape (Nx,Ny,Nz), with keys feature+'_'+method,
+         e.g. 'dtheta_median', along with 'hit_per_voxel'
+        '''
+
+        if(not isinstance(score_features,dict)):
+            score_features = {name:getattr(self.tracks,name) for name in score_features}
+        if(not isinstance(score_methods,dict)):
+            score_methods = {name:name for name in score_methods}
+
+        event_order, offsets = self.get_voxel_grouping(mask=mask)
+
+        voxel_maps = {}
+        for feature, score_feature in score_features.items():
+            score_list = VoxelScores(scores=score_feature,event_order=event_order,offsets=offsets,n_vox_xyz=self.voi.n_vox_xyz)
+            for method, score_method in score_methods.items():
+                voxel_maps[feature+'_'+method] = score_list.reduce(score_method)
+            voxel_maps['hit_per_voxel'] = score_list.count()
+
+        return voxel_maps
+
+    def compute_normalized_poca_positions(self,
+                                          poca_points:Optional[np.ndarray]=None,
+                                          x_range:Optional[Tuple[float]]=None) -> np.array:
 
         '''
         Normalize poca positions so that they range between 0 and 1.
+
+        INPUT:
+         - poca_points:np.ndarray, the POCA points to normalize with shape (n_event,3). If None, the POCA points within the voi are used.
+         - x_range:Tuple[float], the normalization range. If None, the x range of poca_points is used, and stored in self.norm_range.
         '''
         
         def normalize(x,x_min,x_max):
             return (x-x_min)/(x_max-x_min)
 
         from copy import deepcopy
-        norm_poca_points = deepcopy(self.poca_points[self.mask_in_voi])
-        x_min, x_max = np.min(norm_poca_points[:,0]), np.max(norm_poca_points[:,0])
+        norm_poca_points = deepcopy(self.poca_points[self.mask_in_voi] if poca_points is None else poca_points)
+        if(len(norm_poca_points)==0):
+            return norm_poca_points
+        if(x_range is None):
+            x_range = np.min(norm_poca_points[:,0]), np.max(norm_poca_points[:,0])
+            self.norm_range = x_range
+        x_min, x_max = x_range
         for dim in [0,1,2]:
             norm_poca_points[:,dim] = normalize(norm_poca_points[:,dim],x_min,x_max)
 
@@ -257,4 +506,51 @@ class POCA():
 
         
 
-    
\ No newline at end of file
+    
+
+
+def poca_stream_reconstruction(hits:Union[str,Iterable[np.ndarray]],
+                               voi:VolumeInterest,
+                               chunk_size:int=100000,
+                               score_feature:str='dtheta',
+                               dtheta_cut:float=0.005,
+                               fit_method:str='svd',
+                               dtype:Optional[np.dtype]=None,
+                               accumulator:Optional[VoxelAccumulator]=None,
+                               relative_error:Optional[float]=.01,
+                               **kwargs) -> VoxelAccumulator:
+
+    '''
+    POCA reconstruction of a hits file of any size with constant memory. Hits are read chunk by chunk (see iter_hits),
+    and each chunk is tracked, its POCA points computed and their scores folded into a VoxelAccumulator.
+
+    INPUT:
+     - hits:str or Iterable[np.ndarray], a hits file (see iter_hits), or an iterable yielding hits chunks with shape (3,n_plane,chunk)
+     - voi:VolumeInterest, an instance of the VolumeInterest class
+     - chunk_size:int, the number of events read at once
+     - score_feature:str, the tracks feature used as score, e.g. 'dtheta', 'dtheta_x'
+     - dtheta_cut:float, tracks with scattering angle below dtheta_cut [rad] are considered parallel and rejected
+     - fit_method:str, the track fitting method, one of Tracking.fit_methods
+     - dtype:np.dtype, the hits floating point precision
+     - accumulator:VoxelAccumulator, an accumulator to fold the events into, e.g. to resume a reconstruction. If None, a new one is created.
+     - relative_error:float, the relative error of the approximate quantiles, with logarithmic bins (see VoxelAccumulator),
+     as for poca_reconstruction with rebin. If None, uniform bins are used.
+     - kwargs: the other VoxelAccumulator histogram bins arguments, e.g. score_range.
+     Logarithmic bins are signed for the signed scores dtheta_x and dtheta_y, unless signed is provided.
+
+    OUTPUT:
+     - accumulator:VoxelAccumulator, the per voxel statistics, see VoxelAccumulator.reduce for final scores
+    '''
+
+    if(isinstance(hits,str)):
+        hits = iter_hits(hits,chunk_size=chunk_size,dtype=np.float64 if dtype is None else dtype)
+    if(accumulator is None):
+        if(relative_error is not None):
+            kwargs.setdefault('signed',score_feature in ('dtheta_x','dtheta_y'))
+        accumulator = VoxelAccumulator(voi=voi,relative_error=relative_error,**kwargs)
+
+    for chunk in hits:
+        poca = POCA(tracks=Tracking(chunk,fit_method=fit_method,dtype=dtype),voi=voi,dtheta_cut=dtheta_cut)
+        accumulator.fill_indices(poca.triggered_vox_indices,getattr(poca.tracks,score_feature))
+
+    return accumulator
@@ -0,0 +1,213 @@
+#Usual suspects
+import numpy as np
+from typing import Tuple, Optional, Callable, Union
+import functools
+
+
+def fast_reduce(statistics, score_method:Callable) -> Optional[np.ndarray]:
+
+    '''
+    Computes np.mean, np.median, np.var, np.std, np.sum, partial(np.quantile,q=...) and partial(np.percentile,q=...)
+    with the per voxel statistics methods of statistics, e.g. a VoxelScores or VoxelAccumulator instance.
+
+    INPUT:
+     - statistics:VoxelScores or VoxelAccumulator, with mean, median, var, std, sum and quantile methods
+     - score_method:Callable, the score method
+
+    OUTPUT:
+     - final_voxel_scores:np.ndarray, the final scores with shape (Nx,Ny,Nz), or None if score_method is not one of the above
+    '''
+
+    fast_methods = {np.mean:statistics.mean, np.median:statistics.median, np.var:statistics.var, np.std:statistics.std, np.sum:statistics.sum}
+    if(score_method in fast_methods):
+        return fast_methods[score_method]()
+
+    if(isinstance(score_method,functools.partial)):
+        if((score_method.func in (np.quantile,np.percentile)) & (score_method.args==()) & (set(score_method.keywords)=={'q'})):
+            q = score_method.keywords['q']
+            return statistics.quantile(q if score_method.func is np.quantile else np.asarray(q)/100)
+
+    return None
+
+
+def group_by_voxel(voxel_indices:np.ndarray,
+                   n_vox_xyz:np.ndarray,
+                   mask:Optional[np.ndarray]=None) -> Tuple[np.ndarray]:
+
+    '''
+    Sorts the events by voxel, in a CSR-like layout: the events triggering voxel v are
+    event_order[offsets[v]:offsets[v+1]], with v the flat index of the voxel.
+
+    INPUT:
+     - voxel_indices:np.ndarray, the triggered voxel indices with shape (n_event,3), [-1,-1,-1] outside the voi
+     - n_vox_xyz:np.ndarray, the number of voxels along x, y, z
+     - mask:np.ndarray, a boolean mask with size (n_event) of the events to group. If None, all events are used
+
+    OUTPUT:
+     - event_order:np.ndarray, the indices of the grouped events, sorted by voxel
+     - offsets:np.ndarray, the start of each voxel group in event_order, with size (n_voxel+1)
+    '''
+
+    valid = np.all(voxel_indices>=0,axis=1)
+    if(mask is not None):
+        valid &= mask
+
+    events = np.flatnonzero(valid)
+    flat_indices = np.ravel_multi_index(tuple(voxel_indices[events].T),tuple(n_vox_xyz))
+
+    # Stable sort, so that events keep their original order within a voxel
+    order = np.argsort(flat_indices,kind='stable')
+    counts = np.bincount(flat_indices,minlength=np.prod(n_vox_xyz))
+
+    return events[order], np.concatenate([[0],np.cumsum(counts)])
+
+
+class VoxelScores():
+
+    '''
+    Scores of the events grouped by voxel (see group_by_voxel), with segmented per voxel reductions.
+
+    Reductions return arrays with shape (Nx,Ny,Nz), set to 0 for voxels without any event.
+    '''
+
+    reductions = ('count','sum','mean','rms','var','std','median')
+
+    def __init__(self, scores:np.ndarray, event_order:np.ndarray, offsets:np.ndarray, n_vox_xyz:np.ndarray):
+
+        '''
+        INPUT:
+         - scores:np.ndarray, the score of every event, with size (n_event)
+         - event_order:np.ndarray, offsets:np.ndarray, the events grouping, see group_by_voxel
+         - n_vox_xyz:np.ndarray, the number of voxels along x, y, z
+        '''
+
+        self.n_vox_xyz = np.asarray(n_vox_xyz)
+        self.offsets = offsets
+        self.scores = np.asarray(scores)[event_order]
+
+        self.counts = np.diff(offsets)
+        self.occupied = np.flatnonzero(self.counts)
+        self._sorted_scores = None
+
+    @property
+    def sorted_scores(self) -> np.ndarray:
+
+        '''
+        The scores sorted in increasing order within each voxel, computed once for quantiles.
+        '''
+
+        if(self._sorted_scores is None):
+            voxels = np.repeat(np.arange(len(self.counts)),self.counts)
+            self._sorted_scores = self.scores[np.lexsort((self.scores,voxels))]
+        return self._sorted_scores
+
+    def to_voxels(self, values:np.ndarray, dtype:np.dtype=np.float64) -> np.ndarray:
+
+        '''
+        Scatters values computed for the occupied voxels into an array with shape (Nx,Ny,Nz).
+        '''
+
+        voxel_values = np.zeros(len(self.counts),dtype=dtype)
+        voxel_values[self.occupied] = values
+        return voxel_values.reshape(tuple(self.n_vox_xyz))
+
+    def segment_sum(self, values:np.ndarray) -> np.ndarray:
+
+        '''
+        Sums values within each occupied voxel.
+        '''
+
+        if(len(self.occupied)==0):
+            return np.zeros(0,dtype=values.dtype)
+        return np.add.reduceat(values,self.offsets[self.occupied])
+
+    def count(self) -> np.ndarray:
+        return self.counts.reshape(tuple(self.n_vox_xyz)).astype(float)
+
+    def sum(self) -> np.ndarray:
+        return self.to_voxels(self.segment_sum(self.scores))
+
+    def mean(self) -> np.ndarray:
+        return self.to_voxels(self.segment_sum(self.scores)/self.counts[self.occupied])
+
+    def rms(self) -> np.ndarray:
+        return self.to_voxels(np.sqrt(self.segment_sum(self.scores**2)/self.counts[self.occupied]))
+
+    def var(self) -> np.ndarray:
+
+        n = self.counts[self.occupied]
+        mean = self.segment_sum(self.scores)/n
+        residuals = self.scores - np.repeat(mean,n)
+        return self.to_voxels(self.segment_sum(residuals**2)/n)
+
+    def std(self) -> np.ndarray:
+        return np.sqrt(self.var())
+
+    def median(self) -> np.ndarray:
+        return self.quantile(q=.5)
+
+    def quantile(self, q:Union[float,np.ndarray]) -> np.ndarray:
+
+        '''
+        Per voxel quantiles, with the same linear interpolation as np.quantile.
+
+        INPUT:
+         - q:float or np.ndarray, the quantile(s) to compute, between 0 and 1
+
+        OUTPUT:
+         - quantiles:np.ndarray, with shape (Nx,Ny,Nz), or (len(q),Nx,Ny,Nz) if q is an array
+        '''
+
+        q = np.asarray(q,dtype=np.float64)
+        if(q.ndim>0):
+            return np.stack([self.quantile(q_) for q_ in q])
+
+        start, n = self.offsets[self.occupied], self.counts[self.occupied]
+        virtual_index = (n-1)*q
+        previous_index = np.floor(virtual_index)
+        gamma = virtual_index - previous_index
+
+        previous_index = previous_index.astype(int)
+        next_index = np.minimum(previous_index+1,n-1)
+
+        a, b = self.sorted_scores[start+previous_index], self.sorted_scores[start+next_index]
+
+        # Same as np.quantile interpolation, numerically stable on both sides
+        diff_b_a = b - a
+        values = a + diff_b_a*gamma
+        np.subtract(b,diff_b_a*(1-gamma),out=values,where=(gamma>=.5),casting='unsafe')
+
+        return self.to_voxels(values)
+
+    def apply(self, score_method:Callable) -> np.ndarray:
+
+        '''
+        Fallback for arbitrary score methods, called on the scores of each occupied voxel.
+        '''
+
+        values = [score_method(self.scores[self.offsets[v]:self.offsets[v+1]]) for v in self.occupied]
+        return self.to_voxels(np.asarray(values,dtype=np.float64))
+
+    def reduce(self, score_method:Union[str,Callable]) -> np.ndarray:
+
+        '''
+        Computes the final score of every voxel.
+
+        INPUT:
+         - score_method:str or Callable, either one of VoxelScores.reductions, or a function applied to the scores
+         of a voxel. np.mean, np.median, np.var, np.std, np.sum and partial(np.quantile,q=...) are computed with
+         segmented reductions, other functions are called voxel by voxel.
+
+        OUTPUT:
+         - final_voxel_scores:np.ndarray, the final scores with shape (Nx,Ny,Nz)
+        '''
+
+        if(isinstance(score_method,str)):
+            assert score_method in self.reductions, 'score_method must be one of {}'.format(self.reductions)
+            return getattr(self,score_method)()
+
+        final_scores = fast_reduce(self,score_method)
+        if(final_scores is not None):
+            return final_scores
+
+        return self.apply(score_method)
@@ -1,8 +1,14 @@
 #Usual suspects
 import numpy as np
-from typing import Tuple, Optional
+from typing import Tuple, Optional, Dict, Union, Iterable
 import math
-from copy import deepcopy
+import itertools
+from copy import copy
+
+# Muograph
+import sys
+sys.path.insert(1,'../muograph/')
+from utils.arrays import NpyAppender, append_to_buffer
 
 def dot_prod(v1:np.ndarray, v2:np.ndarray) -> np.ndarray:
 
@@ -34,38 +40,666 @@ def norm(v:np.ndarray) -> np.ndarray:
 
     return np.sqrt(np.sum(v**2,axis=0)).round(10)
 
+
+def fit_tracks_svd(hits:np.ndarray) -> Tuple[np.ndarray]:
+
+    '''
+    Fits a 3D line to the hits of every event at once. Equivalent to calling
+    skspatial Line.best_fit event by event: the point is the centroid of the hits,
+    the vector is the first right singular vector of the centered hits.
+    The singular vector sign is arbitrary, and may differ between precisions, so vectors are oriented
+    downward (v_z < 0), as muons go through the planes from top to bottom.
+
+    INPUT:
+     - hits:np.ndarray, the hits of the detection planes to fit, with shape (3,n_plane,n_event)
+
+    OUTPUT:
+     - vectors:np.ndarray, the direction vector of the fitted lines, pointing downward, with shape (3,n_event)
+     - points:np.ndarray, a point on the fitted lines (hits centroid), with shape (3,n_event)
+    '''
+
+    points = hits.mean(axis=1)
+
+    # Stack centered hits as (n_event,n_plane,3) matrices and decompose them all at once
+    centered_hits = np.transpose(hits - points[:,np.newaxis,:],(2,1,0))
+    _, _, vh = np.linalg.svd(centered_hits,full_matrices=False)
+
+    vectors = np.transpose(vh[:,0])
+    np.negative(vectors,out=vectors,where=vectors[2]>0)
+
+    return vectors, points
+
+
+def fit_tracks_lsq(hits:np.ndarray, resolution:Optional[np.ndarray]=None) -> Tuple[np.ndarray]:
+
+    '''
+    Fits x(z) = a + b*z and y(z) = c + d*z to the hits of every event at once, using closed-form
+    weighted least squares. Detection planes sitting at (almost) fixed z, no general 3D fit is needed.
+
+    INPUT:
+     - hits:np.ndarray, the hits of the detection planes to fit, with shape (3,n_plane,n_event)
+     - resolution:np.ndarray, the spatial resolution of each plane along x and y in mm, with shape (n_plane).
+     If None, all planes have a 1 mm resolution.
+
+    OUTPUT:
+     - vectors:np.ndarray, the normalized direction vector of the fitted lines, pointing downward, with shape (3,n_event)
+     - points:np.ndarray, a point on the fitted lines (at the weighted mean z), with shape (3,n_event)
+     - params:np.ndarray, the fitted parameters [a,b,c,d], with shape (4,n_event)
+     - cov:np.ndarray, the covariance matrix of the (intercept,slope) parameters, with shape (2,2,n_event).
+     x and y fits share the same weights and z, hence the same covariance.
+     - chi2:np.ndarray, the chi2 of the x and y fits summed, with shape (n_event)
+    '''
+
+    x, y, z = hits[0], hits[1], hits[2]
+
+    if(resolution is None):
+        resolution = np.ones(hits.shape[1])
+    w = 1/np.asarray(resolution,dtype=float)[:,np.newaxis]**2
+
+    # Work with z centered on its weighted mean to keep the sums well conditioned
+    S = np.sum(w)
+    z_mean = np.sum(w*z,axis=0)/S
+    dz = z - z_mean
+    Szz = np.sum(w*dz**2,axis=0)
+
+    x_mean, y_mean = np.sum(w*x,axis=0)/S, np.sum(w*y,axis=0)/S
+    b, d = np.sum(w*dz*x,axis=0)/Szz, np.sum(w*dz*y,axis=0)/Szz
+    a, c = x_mean - b*z_mean, y_mean - d*z_mean
+
+    # Covariance of the (intercept at z=0, slope) parameters
+    cov = np.zeros((2,2,len(z_mean)))
+    cov[0,0] = 1/S + z_mean**2/Szz
+    cov[1,1] = 1/Szz
+    cov[0,1] = cov[1,0] = -z_mean/Szz
+
+    chi2 = np.sum(w*((x - x_mean - b*dz)**2 + (y - y_mean - d*dz)**2),axis=0)
+
+    # Direction vector pointing downward, as muons go through the planes from top to bottom
+    vectors = -np.stack([b,d,np.ones_like(b)])/np.sqrt(b**2 + d**2 + 1)
+    points = np.stack([x_mean,y_mean,z_mean])
+
+    return vectors, points, np.stack([a,b,c,d]), cov, chi2
+
+
+def fit_tracks_skspatial(hits:np.ndarray) -> Tuple[np.ndarray]:
+
+    '''
+    Event by event version of fit_tracks_svd, using skspatial Line.best_fit.
+    Much slower than the batched fit, kept as a reference.
+
+    INPUT:
+     - hits:np.ndarray, the hits of the detection planes to fit, with shape (3,n_plane,n_event)
+
+    OUTPUT:
+     - vectors:np.ndarray, the direction vector of the fitted lines, pointing downward, with shape (3,n_event)
+     - points:np.ndarray, a point on the fitted lines, with shape (3,n_event)
+    '''
+
+    from skspatial.objects import Line, Points
+    from fastprogress import progress_bar
+
+    vectors, points = np.zeros((3,hits.shape[-1])), np.zeros((3,hits.shape[-1]))
+
+    for ev in progress_bar(range(hits.shape[-1])):
+        line_fit = Line.best_fit(Points(np.transpose(hits[:,:,ev])))
+        vectors[:,ev],points[:,ev] = line_fit.vector.to_array(), line_fit.point.to_array()
+
+    np.negative(vectors,out=vectors,where=vectors[2]>0)
+
+    return vectors, points
+
+
+def fit_tracks(hits:np.ndarray,
+               fit_method:str='svd',
+               resolution:Optional[np.ndarray]=None,
+               dtype:Optional[np.dtype]=None) -> Dict[str,np.ndarray]:
+
+    '''
+    Fits the incoming (upper half of the planes) and outgoing (lower half of the planes) tracks of every event.
+
+    INPUT:
+     - hits:np.ndarray, the hits with shape (3,n_plane,n_event)
+     - fit_method:str, one of 'svd', 'skspatial', 'lsq'
+     - resolution:np.ndarray, the x/y resolution of each plane in mm, with shape (n_plane). Only used by the 'lsq' fit.
+     - dtype:np.dtype, the outputs floating point precision. If None, the hits precision is used.
+
+    OUTPUT:
+     - tracks:Dict[str,np.ndarray], the 'vectors' and 'points' of the fitted tracks with shape (2,3,n_event).
+     The 'lsq' fit also provides 'track_params' (2,4,n_event), 'track_cov' (2,2,2,n_event) and 'chi2' (2,n_event).
+    '''
+
+    n_plane, n_event = hits.shape[1], hits.shape[-1]
+    if(resolution is None):
+        resolution = np.ones(n_plane)
+    if(dtype is None):
+        dtype = hits.dtype if np.issubdtype(hits.dtype,np.floating) else np.float64
+
+    tracks = {'vectors':np.zeros((2,3,n_event),dtype=dtype),
+              'points':np.zeros((2,3,n_event),dtype=dtype)}
+
+    if(fit_method=='lsq'):
+        tracks['track_params'] = np.zeros((2,4,n_event),dtype=dtype)
+        tracks['track_cov'] = np.zeros((2,2,2,n_event),dtype=dtype)
+        tracks['chi2'] = np.zeros((2,n_event),dtype=dtype)
+
+    for planes, dim in zip([slice(None,n_plane//2),slice(n_plane//2,None)], [0,1]):
+        if(fit_method=='lsq'):
+            (tracks['vectors'][dim],tracks['points'][dim],
+             tracks['track_params'][dim],tracks['track_cov'][dim],tracks['chi2'][dim]) = fit_tracks_lsq(hits[:,planes],resolution[planes])
+        elif(fit_method=='skspatial'):
+            tracks['vectors'][dim],tracks['points'][dim] = fit_tracks_skspatial(hits[:,planes])
+        else:
+            tracks['vectors'][dim],tracks['points'][dim] = fit_tracks_svd(hits[:,planes])
+
+    return tracks
+
+
+angular_features = ('theta_in','phi_in','theta_out','phi_out','dtheta','dtheta_x','dtheta_y')
+
+event_columns = ('hits','vectors','points','track_params','track_cov','chi2')
+
+# Version of the columnar format written by Tracking.save
+tracking_format_version = 1
+
+
+def compute_angular_features(vectors_in:np.ndarray,
+                             vectors_out:np.ndarray,
+                             features:Tuple[str]=angular_features,
+                             out:Optional[Union[np.ndarray,Dict[str,np.ndarray]]]=None,
+                             block_size:int=65536) -> Dict[str,np.ndarray]:
+
+    '''
+    Computes the zenith and azimuthal angles of the incoming and outgoing tracks, and the scattering angles
+    between them, in a single pass over the tracks direction vectors. Vectors are never copied, all
+    intermediate results are written in a few float64 scratch buffers of size block_size.
+
+    INPUT:
+     - vectors_in:np.ndarray, the incoming tracks direction, with shape (3,n_event) or (3)
+     - vectors_out:np.ndarray, the outgoing tracks direction, with shape (3,n_event) or (3)
+     - features:Tuple[str], the features to compute, among angular_features
+     - out:np.ndarray or Dict[str,np.ndarray], preallocated outputs, either an array with shape (len(features),n_event)
+     or a dict of arrays with shape (n_event). If None, outputs are allocated. Ignored for single vectors.
+     - block_size:int, the number of events processed at once, i.e. the size of the scratch buffers
+
+    OUTPUT:
+     - features:Dict[str,np.ndarray], the requested features with shape (n_event) or (1)
+
+    The dot products and norms used for scattering angles are rounded as in dot_prod and norm.
+    '''
+
+    assert set(features) <= set(angular_features), 'features must be among {}'.format(angular_features)
+
+    # Single vectors
+    if(vectors_in.ndim==1):
+        outputs = compute_angular_features(vectors_in[:,np.newaxis],vectors_out[:,np.newaxis],features)
+        return {key:value[0] for key, value in outputs.items()}
+
+    shape = vectors_in.shape[1:]
+    if(out is None):
+        out = np.empty((len(features),)+shape,dtype=np.result_type(vectors_in,vectors_out,np.float32))
+    outputs = out if isinstance(out,dict) else dict(zip(features,out))
+
+    # arccos is ill-conditioned close to 1: whatever the vectors precision, cosines are computed in float64.
+    # Vectors are processed by blocks of events, converted into float64 scratch buffers if needed,
+    # so that float32 vectors are never copied as a whole
+    n_event = shape[0]
+    block_size = max(1,min(n_event,block_size))
+    scratch = np.empty((6,block_size))
+    vectors_buffer = np.empty((2,3,block_size)) if (vectors_in.dtype!=np.float64) | (vectors_out.dtype!=np.float64) else None
+
+    for start in range(0,n_event,block_size):
+        stop = min(start+block_size,n_event)
+        tmp, acc, norm_in, norm_out, norm_proj, theta_buffer = scratch[:,:stop-start]
+        block_outputs = {key:outputs[key][start:stop] for key in features}
+
+        if(vectors_buffer is None):
+            v_in, v_out = vectors_in[:,start:stop], vectors_out[:,start:stop]
+        else:
+            v_in, v_out = vectors_buffer[:,:,:stop-start]
+            np.copyto(v_in,vectors_in[:,start:stop])
+            np.copyto(v_out,vectors_out[:,start:stop])
+
+        with np.errstate(invalid='ignore',divide='ignore'):
+
+            # Zenith and azimuthal angles
+            for v, key, v_norm in zip([v_in,v_out],['_in','_out'],[norm_in,norm_out]):
+
+                # Squared norm in the XY plane
+                np.multiply(v[0],v[0],out=norm_proj)
+                np.multiply(v[1],v[1],out=tmp)
+                norm_proj += tmp
+
+                # Norm
+                np.multiply(v[2],v[2],out=tmp)
+                np.add(norm_proj,tmp,out=v_norm)
+                np.sqrt(v_norm,out=v_norm)
+
+                if(('theta'+key in features) | ('phi'+key in features)):
+                    theta = block_outputs['theta'+key] if 'theta'+key in features else theta_buffer
+                    np.divide(v[2],v_norm,out=acc)
+                    np.negative(acc,out=acc)
+                    np.arccos(acc,out=theta)
+
+                if('phi'+key in features):
+                    phi = block_outputs['phi'+key]
+                    np.sqrt(norm_proj,out=norm_proj)
+                    np.divide(v[0],norm_proj,out=acc)
+                    np.arccos(acc,out=acc)
+                    np.sign(v[1],out=tmp)
+                    np.multiply(acc,tmp,out=phi)
+                    np.copyto(phi,0.,where=(theta==0))
+
+            # 3D scattering angle
+            if('dtheta' in features):
+                np.multiply(v_in[0],v_out[0],out=acc)
+                for dim in [1,2]:
+                    np.multiply(v_in[dim],v_out[dim],out=tmp)
+                    acc += tmp
+                np.round(acc,10,out=acc)
+                np.round(norm_in,10,out=norm_in)
+                np.round(norm_out,10,out=norm_out)
+                np.multiply(norm_in,norm_out,out=tmp)
+                acc /= tmp
+                np.clip(acc,-1.,1.,out=acc)
+                np.arccos(acc,out=block_outputs['dtheta'])
+
+            # Projected scattering angles, in the XZ (dim = 0) and YZ (dim = 1) planes
+            for dim, key in zip([0,1],['dtheta_x','dtheta_y']):
+                if(key not in features):
+                    continue
+
+                np.multiply(v_in[dim],v_out[dim],out=acc)
+                np.multiply(v_in[2],v_out[2],out=tmp)
+                acc += tmp
+                np.round(acc,10,out=acc)
+
+                for v, v_norm in zip([v_in,v_out],[norm_in,norm_out]):
+                    np.multiply(v[dim],v[dim],out=v_norm)
+                    np.multiply(v[2],v[2],out=tmp)
+                    v_norm += tmp
+                    np.sqrt(v_norm,out=v_norm)
+                    np.round(v_norm,10,out=v_norm)
+
+                np.multiply(norm_in,norm_out,out=tmp)
+                acc /= tmp
+                np.clip(acc,-1.,1.,out=acc)
+                np.arccos(acc,out=acc)
+
+                # Sign given by the change of direction along the projection axis
+                np.subtract(v_out[dim],v_in[dim],out=tmp)
+                np.negative(acc,out=acc,where=(tmp<=0.))
+                np.copyto(block_outputs[key],acc)
+
+    return {key:outputs[key] for key in features}
+
+
+def _attach_buffer(spec:Tuple) -> Tuple:
+
+    '''
+    Returns the array described by spec = (kind, name, shape, dtype), where kind is 'shm' for a
+    multiprocessing.shared_memory block or 'npy' for a .npy file, along with the shared memory handle if any.
+    '''
+
+    from multiprocessing import shared_memory
+
+    kind, name, shape, dtype = spec
+    if(kind=='npy'):
+        return np.load(name,mmap_mode='r+'), None
+    shm = shared_memory.SharedMemory(name=name)
+    return np.ndarray(shape,dtype=dtype,buffer=shm.buf), shm
+
+
+def _compute_tracks_shared(tracks, hits_spec:Tuple, output_specs:Dict[str,Tuple], start:int, stop:int) -> None:
+
+    '''
+    Process pool task of Tracking.compute_tracks_parallel: fits events [start,stop) read from the shared hits
+    buffer and writes the results in place in the shared output buffers.
+    '''
+
+    handles = []
+    hits, shm = _attach_buffer(hits_spec)
+    handles.append(shm)
+
+    columns = tracks.compute_tracks_chunk(hits[:,:,start:stop])
+    for key, value in columns.items():
+        output, shm = _attach_buffer(output_specs[key])
+        handles.append(shm)
+        output[...,start:stop] = value
+        del output
+
+    del hits
+    for shm in handles:
+        if(shm is not None):
+            shm.close()
+
+
+class _CachedFeature():
+
+    '''
+    Derived feature of a Tracking instance, computed on first access by Tracking.get_feature
+    and cached until the event selection changes.
+    '''
+
+    def __set_name__(self, owner, name:str) -> None:
+        self.name = name
+
+    def __get__(self, tracks, owner=None):
+        if(tracks is None):
+            return self
+        return tracks.get_feature(self.name)
+
+    def __set__(self, tracks, value:np.ndarray) -> None:
+        tracks._features[self.name] = value
+        tracks._columns.pop(self.name,None)
+        tracks._buffers.pop(('feature',self.name),None)
+        tracks._buffers.pop(('column',self.name),None)
+
+
+class _EventColumn():
+
+    '''
+    Per-event array of a Tracking instance (event axis last). The array of all events is stored once
+    and shared between selections, the selected events are sliced on first access and cached.
+    '''
+
+    def __set_name__(self, owner, name:str) -> None:
+        self.name = name
+
+    def __get__(self, tracks, owner=None):
+        if(tracks is None):
+            return self
+        column = tracks._columns.get(self.name)
+        if((column is None) | (tracks._index is None)):
+            return column
+        if(self.name not in tracks._features):
+            tracks._features[self.name] = column[...,tracks._index]
+        return tracks._features[self.name]
+
+    def __set__(self, tracks, value:Optional[np.ndarray]) -> None:
+        assert tracks._index is None, 'Cannot set {} on a selection of events'.format(self.name)
+        tracks._columns[self.name] = value
+        tracks._buffers.pop(('column',self.name),None)
+        tracks._features = {}
+
+
 # Muograph
 class Tracking():
-    
+
     '''
     Class for muon tracking in the context of an MST experiment.
-    
+
     Assumptions:
-    
+
      - Perfect detector alignment
+
+    Fit methods:
+
+     - 'svd': batched 3D line fit of all events at once (default)
+     - 'skspatial': event by event fit using skspatial Line.best_fit (slow, kept as reference)
+     - 'lsq': closed-form weighted least squares fit of x(z) and y(z), using the planes resolution.
+     Also provides the fitted parameters covariance and chi2 of each track.
+
+    Chunked mode:
+
+    When chunk_size is provided, or when hits is an iterable of hit chunks, tracks are fitted chunk by chunk.
+    If output_dir is provided, vectors, points and angles are written in memory-mapped .npy files in output_dir,
+    so that peak memory is bounded by the chunk size.
+
+    Derived features:
+
+    Angles (theta_in, phi_in, theta_out, phi_out, dtheta, dtheta_x, dtheta_y) are computed on first access
+    and cached until the event selection changes. In chunked and multi-core modes, they are computed along with the fit.
+
+    Event selection:
+
+    A selection is an array of event indices. Tracking.select returns a new Tracking sharing the arrays of all
+    events with the original one, whose hits, tracks and features are only sliced when accessed.
+    Selections compose, and the original Tracking is left untouched.
+
+    Multi-core mode:
+
+    When n_workers > 1, the event axis is split across a process pool. Hits and outputs live in shared memory
+    (or in memory-mapped .npy files), so that workers read and write them in place and no array is pickled.
     '''
 
-    def __init__(self, hits:np.ndarray, E:Optional[np.ndarray]=None):
+    fit_methods = ('svd','skspatial','lsq')
+
+    # Hits and fitted tracks
+    hits, vectors, points = _EventColumn(), _EventColumn(), _EventColumn()
+    track_params, track_cov, chi2 = _EventColumn(), _EventColumn(), _EventColumn()
+
+    # Zenith and azymuthal angles
+    theta_in, phi_in = _CachedFeature(), _CachedFeature()
+    theta_out, phi_out = _CachedFeature(), _CachedFeature()
+
+    # Scattering angles
+    dtheta, dtheta_x, dtheta_y = _CachedFeature(), _CachedFeature(), _CachedFeature()
+
+    def __init__(self,
+                 hits:Union[np.ndarray,str,Iterable[np.ndarray]],
+                 E:Optional[np.ndarray]=None,
+                 fit_method:str='svd',
+                 resolution:Optional[np.ndarray]=None,
+                 chunk_size:Optional[int]=None,
+                 output_dir:Optional[str]=None,
+                 n_workers:int=1,
+                 dtype:Optional[np.dtype]=None):
+
+        '''
+        INPUT:
+         - hits:np.ndarray, the hits with shape (3,n_plane,n_event). Can also be the filename of a .npy hits file,
+         which is memory-mapped, or an iterable yielding hits chunks with shape (3,n_plane,chunk).
+         - fit_method:str, the track fitting method, one of Tracking.fit_methods
+         - resolution:np.ndarray, the x/y resolution of each plane in mm, with shape (n_plane). Only used by the 'lsq' fit.
+         - chunk_size:int, the number of events processed at once in chunked mode
+         - output_dir:str, the directory where the chunked mode outputs are memory-mapped. If None, outputs are kept in memory.
+         - n_workers:int, the number of processes used to fit the tracks
+         - dtype:np.dtype, the floating point precision of the tracks and features (e.g. np.float32).
+         Hits are cast chunk by chunk. If None, the hits precision is used.
+        '''
+
+        assert fit_method in self.fit_methods, 'fit_method must be one of {}'.format(self.fit_methods)
+
+        hits_file = None
+        if(isinstance(hits,str)):
+            hits_file, hits = hits, np.load(hits,mmap_mode='r')
+
+        if(isinstance(hits,np.ndarray)):
+            self.n_plane = hits.shape[1]
+            chunks = None if chunk_size is None else (hits[:,:,i:i+chunk_size] for i in range(0,hits.shape[-1],chunk_size))
+        else:
+            assert n_workers==1, 'n_workers>1 requires hits as an array or a .npy filename'
+            chunks = iter(hits)
+            first_chunk = next(chunks)
+            self.n_plane = first_chunk.shape[1]
+            chunks = itertools.chain([first_chunk],chunks)
+
+        self.fit_method = fit_method
+        self.resolution = np.ones(self.n_plane) if resolution is None else np.asarray(resolution,dtype=float)
+
+        if(dtype is None):
+            dtype = hits.dtype if isinstance(hits,np.ndarray) else first_chunk.dtype
+            dtype = dtype if np.issubdtype(dtype,np.floating) else np.float64
+        self.dtype = np.dtype(dtype)
 
-        self.hits = hits
-        self.n_event = hits.shape[-1]
-        self.n_plane = hits.shape[1]
-        
         self.E = None
-        
-        # Tracking
-        self.vectors, self.points = self.compute_points_vectors_from_hits()
 
-        # Zenith and azymuthal angles
-        self.theta_in, self.phi_in = self.compute_theta_phi(vectors=self.vectors[0])
-        self.theta_out, self.phi_out = self.compute_theta_phi(vectors=self.vectors[1])
-        
-        # Scattering angles
-        self.dtheta, self.dtheta_x, self.dtheta_y = self.compute_dtheta_from_vectors(vectors_in=self.vectors[0],
-                                                                                     vectors_out=self.vectors[1])
+        # Arrays of all events, indices of the selected events (None if all events are selected)
+        # and cache of the selected/derived features, see Tracking.get_feature
+        self._columns, self._index, self._features = {}, None, {}
+
+        # Storage with spare capacity of the arrays, so that extending them is O(new events), see Tracking.extend
+        self._buffers = {}
+
+        # Track fit quality, only available with the 'lsq' fit
+        self.track_params, self.track_cov, self.chi2 = None, None, None
+        self.ndof = 2*(self.n_plane//2 - 2)
+
+        print("Tracking in progress...")
+        if(n_workers>1):
+            columns = self.compute_tracks_parallel(hits,n_workers,chunk_size,output_dir,hits_file)
+        elif(chunks is None):
+            # Angles are computed on first access only
+            columns = self.compute_tracks_chunk(hits,features=())
+        else:
+            columns = self.compute_tracks_by_chunk(chunks,output_dir)
+        print("Tracking completed!")
+
+        # Hits chunks from an iterable are not kept in memory
+        self.hits = hits if isinstance(hits,np.ndarray) else None
+
+        # Tracking, zenith and azymuthal angles, scattering angles
+        for key, value in columns.items():
+            setattr(self,key,value)
+
+        # Memory-mapped outputs are extended on disk
+        for key, value in columns.items():
+            if(isinstance(value,np.memmap)):
+                self._buffers[('column' if key in event_columns else 'feature',key)] = value.filename
+
+
+    def compute_tracks_chunk(self, hits:np.ndarray, features:Tuple[str]=angular_features) -> Dict[str,np.ndarray]:
+
+        '''
+        Fits the tracks of a chunk of events and computes their angles.
+
+        INPUT:
+         - hits:np.ndarray, the hits with shape (3,n_plane,chunk)
+         - features:Tuple[str], the angular features to compute along with the fit
+
+        OUTPUT:
+         - columns:Dict[str,np.ndarray], the fitted tracks (see fit_tracks) along with
+         the requested features (theta_in, phi_in, theta_out, phi_out, dtheta, dtheta_x, dtheta_y) with shape (chunk)
+        '''
+
+        columns = fit_tracks(np.asarray(hits,dtype=self.dtype),self.fit_method,self.resolution,self.dtype)
+
+        # Zenith and azymuthal angles, scattering angles
+        if(len(features)>0):
+            columns.update(compute_angular_features(vectors_in=columns['vectors'][0],
+                                                    vectors_out=columns['vectors'][1],
+                                                    features=features))
+        return columns
+
+
+    def compute_tracks_by_chunk(self, chunks:Iterable[np.ndarray], output_dir:Optional[str]=None) -> Dict[str,np.ndarray]:
+
+        '''
+        Runs compute_tracks_chunk over chunks of events, and gathers the outputs either in memory
+        or in memory-mapped .npy files.
+
+        INPUT:
+         - chunks:Iterable[np.ndarray], the hits chunks with shape (3,n_plane,chunk)
+         - output_dir:str, the directory where outputs are written as .npy files. If None, outputs are kept in memory.
+
+        OUTPUT:
+         - columns:Dict[str,np.ndarray], see compute_tracks_chunk
+        '''
+
+        import os
+
+        if(output_dir is not None):
+            os.makedirs(output_dir,exist_ok=True)
+
+        outputs = {}
+        for chunk in chunks:
+            for key, value in self.compute_tracks_chunk(chunk).items():
+                if(key not in outputs):
+                    if(output_dir is None):
+                        outputs[key] = []
+                    else:
+                        filename = os.path.join(output_dir,key+'.npy')
+                        assert (os.path.isfile(filename)==False), '{} file already exists!'.format(filename)
+                        outputs[key] = NpyAppender(filename,value.dtype,value.shape[:-1])
+                outputs[key].append(value)
+
+        if(output_dir is None):
+            return {key:np.concatenate(value,axis=-1) for key, value in outputs.items()}
+        return {key:value.close() for key, value in outputs.items()}
+
+
+    def compute_tracks_parallel(self,
+                                hits:np.ndarray,
+                                n_workers:int,
+                                chunk_size:Optional[int]=None,
+                                output_dir:Optional[str]=None,
+                                hits_file:Optional[str]=None) -> Dict[str,np.ndarray]:
+
+        '''
+        Runs compute_tracks_chunk over chunks of events in a pool of n_workers processes.
+        Hits and outputs are shared with the workers through multiprocessing.shared_memory, or through
+        memory-mapped .npy files when hits_file / output_dir are provided.
+
+        INPUT:
+         - hits:np.ndarray, the hits with shape (3,n_plane,n_event)
+         - n_workers:int, the number of processes
+         - chunk_size:int, the number of events per task. If None, events are split evenly between workers.
+         - output_dir:str, the directory where outputs are written as .npy files. If None, outputs are kept in memory.
+         - hits_file:str, the .npy file hits are memory-mapped from, if any. Workers then read it directly.
+
+        OUTPUT:
+         - columns:Dict[str,np.ndarray], see compute_tracks_chunk
+        '''
+
+        import os
+        from multiprocessing import shared_memory
+        from concurrent.futures import ProcessPoolExecutor
+
+        n_event = hits.shape[-1]
+        if(chunk_size is None):
+            chunk_size = -(-n_event//n_workers)
+
+        # Output layout, from a single event
+        layout = {key:(value.shape[:-1]+(n_event,),value.dtype) for key, value in self.compute_tracks_chunk(hits[:,:,:1]).items()}
+
+        if(output_dir is not None):
+            os.makedirs(output_dir,exist_ok=True)
+
+        shms, outputs, output_specs = [], {}, {}
+        try:
+            if(hits_file is None):
+                shm = shared_memory.SharedMemory(create=True,size=max(hits.nbytes,1))
+                shms.append(shm)
+                np.copyto(np.ndarray(hits.shape,dtype=hits.dtype,buffer=shm.buf),hits)
+                hits_spec = ('shm',shm.name,hits.shape,hits.dtype)
+            else:
+                hits_spec = ('npy',hits_file,hits.shape,hits.dtype)
+
+            for key, (shape, dtype) in layout.items():
+                if(output_dir is None):
+                    shm = shared_memory.SharedMemory(create=True,size=max(int(np.prod(shape))*dtype.itemsize,1))
+                    shms.append(shm)
+                    outputs[key] = np.ndarray(shape,dtype=dtype,buffer=shm.buf)
+                    output_specs[key] = ('shm',shm.name,shape,dtype)
+                else:
+                    filename = os.path.join(output_dir,key+'.npy')
+                    assert (os.path.isfile(filename)==False), '{} file already exists!'.format(filename)
+                    # Fortran order, as in chunked mode, so that events can be appended to the file (see Tracking.extend)
+                    outputs[key] = np.lib.format.open_memmap(filename,mode='w+',dtype=dtype,shape=shape,fortran_order=True)
+                    output_specs[key] = ('npy',filename,shape,dtype)
+
+            with ProcessPoolExecutor(max_workers=n_workers) as executor:
+                tasks = [executor.submit(_compute_tracks_shared,self,hits_spec,output_specs,start,min(start+chunk_size,n_event))
+                         for start in range(0,n_event,chunk_size)]
+                for task in tasks:
+                    task.result()
+
+            if(output_dir is None):
+                columns = {key:np.array(value) for key, value in outputs.items()}
+            else:
+                for value in outputs.values():
+                    value.flush()
+                columns = {key:np.load(spec[1],mmap_mode='r') for key, spec in output_specs.items()}
+        finally:
+            # Shared buffers can only be released once no array points to them
+            outputs = None
+            for shm in shms:
+                shm.close()
+                shm.unlink()
+
+        return columns
+
 
-      
-        
     def compute_points_vectors_from_hits(self) -> Tuple[np.ndarray]:
 
         '''
@@ -79,24 +713,10 @@ class Tracking():
           - `vector:np.ndarray`, the direction **vector** of the fitted line (A in eq. (1)) with shape (2,3,n_event)
         '''
 
-        from skspatial.objects import Line, Points
-        from fastprogress import progress_bar
-
-        vectors = np.zeros((2,int(self.n_plane/2),self.n_event))
-        points = np.zeros((2,int(self.n_plane/2),self.n_event))
-        
-        print("Tracking in progress...")
-        
-        for ev in progress_bar(range(self.n_event)):
-            for sub_hits, dim in zip([self.hits[:,:3],self.hits[:,3:]], [0,1]):
-                points_to_fit = (np.transpose(sub_hits[:,:,ev]))
-                line_fit = Line.best_fit(Points(points_to_fit))
-                vectors[dim,:,ev],points[dim,:,ev] = line_fit.vector.to_array(), line_fit.point.to_array()
-        print("Tracking completed!")
+        tracks = fit_tracks(np.asarray(self.hits,dtype=self.dtype),self.fit_method,self.resolution,self.dtype)
 
-        return vectors, points
+        return tracks['vectors'], tracks['points']
 
-        
     def compute_theta_phi(self, vectors:np.ndarray) -> Tuple[np.ndarray]:
     
         '''
@@ -109,11 +729,9 @@ class Tracking():
 
         '''
 
-        theta = np.arccos(-vectors[2]/(np.sqrt(vectors[0]**2+vectors[1]**2+vectors[2]**2)))
-        phi = np.sign(vectors[1])*np.arccos(vectors[0]/np.sqrt(vectors[0]**2+vectors[1]**2))
-        phi = np.where(theta==0,0.,phi)
+        features = compute_angular_features(vectors_in=vectors,vectors_out=vectors,features=('theta_in','phi_in'))
 
-        return theta, phi
+        return features['theta_in'], features['phi_in']
     
             
     def compute_dtheta_from_vectors(self, vectors_in:np.ndarray, vectors_out:np.ndarray) -> Tuple[np.ndarray]:
@@ -132,40 +750,104 @@ class Tracking():
           - dtheta_y:np.ndarray, the projected scattering angle (YZ plane) between vectors_in and vectors_out, with shape (n_event) or (1)
           
         '''
-        # 3D scattering angle
-        dtheta = np.arccos(dot_prod(v1=vectors_in,v2=vectors_out) / (norm(vectors_in)*norm(vectors_out)))
-        
-        # projected angles
-        vectors_x_in, vectors_x_out = deepcopy(vectors_in), deepcopy(vectors_out)
-        vectors_y_in, vectors_y_out = deepcopy(vectors_in), deepcopy(vectors_out)
-        
-        # projection in XZ plane
-        vectors_x_in[1],vectors_x_out[1] = 0., 0.
-        inside_cos = dot_prod(v1=vectors_x_in,v2=vectors_x_out) / (norm(vectors_x_in)*norm(vectors_x_out))
-        inside_cos = np.where(inside_cos>1.,1.,inside_cos)
-        dtheta_x = np.arccos(inside_cos)
-        dtheta_x = np.where((vectors_x_out[0]-vectors_x_in[0])>0.,dtheta_x,-dtheta_x)
-        
-        # projection in YZ plane
-        vectors_y_in[0],vectors_y_out[0] = 0., 0.
-        inside_cos = dot_prod(v1=vectors_y_in,v2=vectors_y_out) / (norm(vectors_y_in)*norm(vectors_y_out))
-        inside_cos = np.where(inside_cos>1.,1.,inside_cos)
-        dtheta_y = np.arccos(inside_cos)
-        dtheta_y = np.where((vectors_y_out[1]-vectors_y_in[1])>0.,dtheta_y,-dtheta_y)
-        return dtheta, dtheta_x, dtheta_y
+        features = compute_angular_features(vectors_in=vectors_in,vectors_out=vectors_out,features=('dtheta','dtheta_x','dtheta_y'))
+
+        return features['dtheta'], features['dtheta_x'], features['dtheta_y']
     
     
-    def save(self, filename:str, directory:str="../data/tracking/") -> None:
-        
-        import pickle
-        import os.path
-        assert (os.path.isfile(directory+filename)==False), '{} file already exists!\
+    def save(self, filename:str, directory:str="../data/tracking/", features:Tuple[str]=angular_features) -> None:
+
+        '''
+        Saves the selected events in a columnar format: a filename directory containing one .npy file per
+        array (hits, vectors, points, fit quality and features) and a metadata.json header.
+        Use Tracking.load to read it back, possibly only some of the columns.
+
+        INPUT:
+         - filename:str, the name of the directory to create
+         - directory:str, the parent directory
+         - features:Tuple[str], the derived features to save along with the tracks
+        '''
+
+        import os
+        import json
+
+        path = os.path.join(directory,filename)
+        assert (os.path.exists(path)==False), '{} file already exists!\
         \n Please choose another filename or delete existing file.'.format(filename)
-        
-        with open(directory+filename, 'wb') as f:
-            pickle.dump(self,f)
-            print("tracking class saved in {}".format(directory+filename))
-            
+        os.makedirs(path)
+
+        columns = {name:getattr(self,name) for name in event_columns+tuple(features)}
+        columns = {name:value for name, value in columns.items() if value is not None}
+
+        for name, value in columns.items():
+            np.save(os.path.join(path,name+'.npy'),value)
+
+        metadata = {'version':tracking_format_version,
+                    'n_event':int(self.n_event),
+                    'n_plane':int(self.n_plane),
+                    'fit_method':self.fit_method,
+                    'dtype':self.dtype.str,
+                    'resolution':self.resolution.tolist(),
+                    'ndof':int(self.ndof),
+                    'columns':{name:{'dtype':np.lib.format.dtype_to_descr(value.dtype),'shape':list(value.shape)}
+                               for name, value in columns.items()}}
+
+        with open(os.path.join(path,'metadata.json'),'w') as f:
+            json.dump(metadata,f,indent=1)
+        print("tracking class saved in {}".format(path))
+
+
+    @classmethod
+    def load(cls,
+             filename:str,
+             directory:str="../data/tracking/",
+             columns:Optional[Tuple[str]]=None,
+             mmap_mode:Optional[str]='r') -> 'Tracking':
+
+        '''
+        Loads a Tracking instance saved with Tracking.save, without refitting the tracks.
+
+        INPUT:
+         - filename:str, the name of the saved directory
+         - directory:str, the parent directory
+         - columns:Tuple[str], the columns to read (e.g. ('points','dtheta')). If None, all saved columns are read.
+         Features which are not read are computed from vectors on first access, if vectors are read.
+         - mmap_mode:str, the np.load memory-map mode. If 'r', columns are only read from disk when accessed.
+         If None, the requested columns are read in memory.
+
+        OUTPUT:
+         - tracks:Tracking, the loaded tracks
+        '''
+
+        import os
+        import json
+
+        path = os.path.join(directory,filename)
+        with open(os.path.join(path,'metadata.json')) as f:
+            metadata = json.load(f)
+
+        if(columns is None):
+            columns = tuple(metadata['columns'])
+        missing = set(columns) - set(metadata['columns'])
+        assert len(missing)==0, 'Columns {} are not available in {}'.format(missing,path)
+
+        tracks = cls.__new__(cls)
+        tracks.__dict__.update({'n_plane':metadata['n_plane'],
+                                'fit_method':metadata['fit_method'],
+                                'dtype':np.dtype(metadata['dtype']),
+                                'resolution':np.array(metadata['resolution']),
+                                'ndof':metadata['ndof'],
+                                'E':None,
+                                '_columns':{name:None for name in event_columns},
+                                '_index':None,
+                                '_features':{},
+                                '_buffers':{}})
+
+        # Loaded features are stored as arrays of all events, like the event columns, so that selections slice them
+        for name in columns:
+            tracks._columns[name] = np.load(os.path.join(path,name+'.npy'),mmap_mode=mmap_mode)
+
+        return tracks
 
 
     def plot_tracking_summary(self, figname:str=None, directory:str='../figures/tracking_summary/',mask:np.ndarray=None):
@@ -219,9 +901,66 @@ class Tracking():
             plt.savefig(directory+figname)
         plt.show()
         
+    @property
+    def n_event(self) -> int:
+        if(self._index is not None):
+            return len(self._index)
+        # Loaded instances may only hold some of the columns
+        for value in itertools.chain(self._columns.values(),self._features.values()):
+            if(value is not None):
+                return value.shape[-1]
+
+
+    @property
+    def selected_indices(self) -> np.ndarray:
+
+        '''
+        The indices of the selected events among all the events.
+        '''
+
+        return np.arange(self.n_event) if self._index is None else self._index
+
+
+    def select(self, mask:np.ndarray) -> 'Tracking':
+
+        '''
+        Returns a selection of events, without copying any array. The current instance is not modified.
+
+        INPUT:
+
+         - mask:np.ndarray, a boolean array with size (n_event), or an array of event indices
+
+        OUTPUT:
+
+         - tracks:Tracking, the selected events
+        '''
+
+        mask = np.asarray(mask)
+        if(mask.dtype==bool):
+            assert len(mask)==self.n_event, 'mask must have size n_event = {}'.format(self.n_event)
+            mask = np.flatnonzero(mask)
+
+        tracks = copy(self)
+        tracks._columns = dict(self._columns)
+
+        if(self._index is None):
+            # Indices among all the events, without allocating np.arange(n_event)
+            if(np.any((mask>=self.n_event) | (mask<-self.n_event))):
+                raise IndexError('Event indices out of range for n_event = {}'.format(self.n_event))
+            tracks._index = np.where(mask<0,mask+self.n_event,mask)
+        else:
+            tracks._index = self._index[mask]
+        tracks._features = {}
+        # Arrays shared with self are never written in place by the selection
+        tracks._buffers = {}
+
+        return tracks
+
+
     def apply_mask(self, mask:np.ndarray) -> None:
         '''
         Apply mask to all class attributes. Can be used to apply event selection.
+        Arrays are not copied, see Tracking.select.
 
         INPUT:
 
@@ -229,14 +968,172 @@ class Tracking():
 
         '''
 
-        for key in self.__dict__.keys():
-            attribute = getattr(self,key)
-            if(type(attribute)==np.ndarray):
-                if(len(attribute.shape)==1):
-                    setattr(self,key,attribute[mask])
-                if(len(attribute.shape)==3):
-                    setattr(self,key,attribute[:,:,mask])
-                    
-        self.n_event = np.count_nonzero(mask)
+        self._index = self.select(mask)._index
+
+        # Selected arrays and derived features are recomputed from the selected tracks
+        self._features = {}
+
+
+    def extend(self, new_hits:np.ndarray) -> None:
+
+        '''
+        Fits the tracks of new events and appends them, e.g. when new hit files arrive during an exposure.
+        Only the new events are fitted, and derived features already computed are only computed for the new events.
+        If the instance is a selection, the new events are added to the selection.
+
+        Arrays are stored with spare capacity, doubled when full, so that the cost of an update is amortized O(new events).
+        Memory-mapped outputs of the chunked mode are extended on disk. Other arrays not created by this instance
+        (e.g. hits memory-mapped from a .npy file, or the arrays of all events for a selection) are copied in memory on the first update.
+
+        INPUT:
+
+         - new_hits:np.ndarray, the hits of the new events, with shape (3,n_plane,n_new)
+        '''
+
+        assert new_hits.shape[1]==self.n_plane, 'new_hits must have {} planes'.format(self.n_plane)
+        assert self._columns['vectors'] is not None, 'Cannot extend tracks loaded without vectors'
+
+        n_all, n_selected, n_new = self._columns['vectors'].shape[-1], self.n_event, new_hits.shape[-1]
+
+        # Loaded features are stored with the columns, and computed for the new events
+        new_columns = self.compute_tracks_chunk(new_hits,features=tuple(name for name in angular_features if self._columns.get(name) is not None))
+        new_columns['hits'] = new_hits
+
+        for name, column in self._columns.items():
+            if(column is not None):
+                self._columns[name] = self.append_events(('column',name),column,new_columns[name])
+
+        if(self._index is not None):
+            self._index = self.append_events(('index',None),self._index,np.arange(n_all,n_all+n_new))
+
+        self.append_features(self.select(np.arange(n_selected,n_selected+n_new)))
+
+
+    def extend_selection(self, tracks:'Tracking', indices:np.ndarray) -> None:
+
+        '''
+        Adds events of tracks to the selection, e.g. once tracks has been extended (see Tracking.extend).
+        Derived features already computed are only computed for the added events.
+
+        INPUT:
+
+         - tracks:Tracking, the instance self is a selection of (see Tracking.select)
+         - indices:np.ndarray, the indices of the added events among the events of tracks
+        '''
+
+        assert self._index is not None, 'extend_selection requires a selection of events, see Tracking.select'
+
+        new_tracks = tracks.select(indices)
+        self._columns = dict(tracks._columns)
+        self._index = self.append_events(('index',None),self._index,new_tracks._index)
+        self.append_features(new_tracks)
+
+
+    def append_features(self, new_tracks:'Tracking') -> None:
+
+        '''
+        Appends the derived features and selected arrays already computed for the events of new_tracks.
+        '''
+
+        for name, value in self._features.items():
+            self._features[name] = self.append_events(('feature',name),value,getattr(new_tracks,name))
+
+
+    def append_events(self, key:Tuple[str], array:np.ndarray, new_values:np.ndarray) -> np.ndarray:
+
+        '''
+        Appends new_values to array along the event axis, in the storage of key (see append_to_buffer).
+        '''
+
+        array, self._buffers[key] = append_to_buffer(array,new_values,self._buffers.get(key))
+        return array
+
+
+    def get_feature(self, name:str) -> np.ndarray:
+
+        '''
+        Returns a derived feature of the tracks, computing it on first access.
+
+        INPUT:
+         - name:str, the feature name, one of angular_features
+
+        OUTPUT:
+         - feature:np.ndarray, the feature with shape (n_event)
+        '''
+
+        # Loaded features are stored and selected like the event columns, see Tracking.load
+        column = self._columns.get(name)
+        if((column is not None) & (self._index is None)):
+            return column
+
+        if(name not in self._features):
+            if(column is not None):
+                self._features[name] = column[...,self._index]
+            elif(self.vectors is None):
+                raise ValueError('{} was not loaded, and cannot be computed without the vectors column. '.format(name) +
+                                 'Load it with Tracking.load(..., columns=(...,\'{}\')) or along with \'vectors\''.format(name))
+            else:
+                self._features.update(compute_angular_features(vectors_in=self.vectors[0],
+                                                               vectors_out=self.vectors[1],
+                                                               features=(name,)))
+        return self._features[name]
+
+
+    def __getstate__(self) -> Dict:
+
+        # Arrays are pickled without their spare capacity
+        state = dict(self.__dict__)
+        state['_buffers'] = {}
+        return state
+
+
+    def __setstate__(self, state:Dict) -> None:
+
+        # Tracking instances pickled before selections and cached features store every array as attribute
+        if('_columns' not in state):
+            state['_columns'] = {name:state.pop(name,None) for name in event_columns}
+            state['_index'] = None
+            state.pop('n_event',None)
+            state.setdefault('fit_method','skspatial')
+            state.setdefault('dtype',np.dtype(np.float64))
+            state.setdefault('resolution',np.ones(state['n_plane']))
+            state.setdefault('ndof',2*(state['n_plane']//2 - 2))
+        state.setdefault('_buffers',{})
+        features = state.setdefault('_features',{})
+        for name in angular_features:
+            if(name in state):
+                features[name] = state.pop(name)
+        self.__dict__.update(state)
+
+    
+
+
+def convert_pickle_to_columnar(filename:str,
+                               directory:str="../data/tracking/",
+                               new_filename:Optional[str]=None,
+                               features:Tuple[str]=angular_features) -> str:
+
+    '''
+    Converts a Tracking instance saved with pickle (e.g. data/tracking/tracks_tutorial) to the columnar format of Tracking.save.
+
+    INPUT:
+     - filename:str, the pickle file name
+     - directory:str, the directory of the pickle file, where the columnar directory is created
+     - new_filename:str, the name of the columnar directory. If None, filename + '_columnar' is used.
+     - features:Tuple[str], the derived features to save
+
+    OUTPUT:
+     - new_filename:str, the name of the columnar directory
+    '''
+
+    import os
+    import pickle
+
+    with open(os.path.join(directory,filename),'rb') as f:
+        tracks = pickle.load(f)
+
+    if(new_filename is None):
+        new_filename = filename + '_columnar'
+    tracks.save(filename=new_filename,directory=directory,features=features)
 
-    
\ No newline at end of file
+    return new_filename
@@ -0,0 +1,120 @@
+#Usual suspects
+import numpy as np
+from typing import Tuple, Optional, Union
+import struct
+
+
+class NpyAppender():
+
+    '''
+    Writes an array chunk by chunk along its last (event) axis into a .npy file, without
+    knowing the final number of events in advance. Data is stored in Fortran order so that
+    appending events only appends bytes, and the header is rewritten once all chunks are written.
+    '''
+
+    header_size = 128
+
+    def __init__(self, filename:str, dtype:np.dtype, shape:Tuple[int]):
+
+        self.filename = filename
+        self.dtype = np.dtype(dtype)
+        self.shape = tuple(shape)
+        self.n_event = 0
+        self.file = open(filename,'wb')
+        self.write_header()
+
+    def write_header(self) -> None:
+
+        header = "{{'descr': {!r}, 'fortran_order': True, 'shape': {}, }}".format(np.lib.format.dtype_to_descr(self.dtype),
+                                                                             self.shape + (self.n_event,))
+        # magic string (6 bytes) + version (2 bytes) + header length (2 bytes) + header
+        header = header.ljust(self.header_size - 11) + '\n'
+        self.file.seek(0)
+        self.file.write(b'\x93NUMPY\x01\x00' + struct.pack('<H',len(header)) + header.encode('latin1'))
+        self.file.seek(0,2)
+
+    def append(self, chunk:np.ndarray) -> None:
+
+        self.file.write(np.asarray(chunk,dtype=self.dtype).tobytes(order='F'))
+        self.n_event += chunk.shape[-1]
+
+    def close(self) -> np.ndarray:
+
+        self.write_header()
+        self.file.close()
+        return np.load(self.filename,mmap_mode='r')
+
+    @classmethod
+    def reopen(cls, filename:str) -> 'NpyAppender':
+
+        '''
+        Reopens a .npy file written by NpyAppender, or in Fortran order with a header of header_size bytes,
+        to append events to it. Raises a ValueError for other .npy files.
+        '''
+
+        with open(filename,'rb') as f:
+            version = np.lib.format.read_magic(f)
+            if(version!=(1,0)):
+                raise ValueError('{} is not an appendable .npy file'.format(filename))
+            shape, fortran_order, dtype = np.lib.format.read_array_header_1_0(f)
+            if((not fortran_order) | (f.tell()!=cls.header_size) | (len(shape)==0)):
+                raise ValueError('{} is not an appendable .npy file'.format(filename))
+
+        appender = cls.__new__(cls)
+        appender.filename, appender.dtype, appender.shape, appender.n_event = filename, dtype, shape[:-1], shape[-1]
+        appender.file = open(filename,'r+b')
+        appender.file.truncate(cls.header_size + int(np.prod(shape))*dtype.itemsize)
+        appender.file.seek(0,2)
+        return appender
+
+
+def append_to_buffer(array:np.ndarray,
+                     new_values:np.ndarray,
+                     buffer:Optional[Union[np.ndarray,str]]=None,
+                     axis:int=-1) -> Tuple[np.ndarray,Union[np.ndarray,str]]:
+
+    '''
+    Appends new events to a per-event array, in amortized O(new events), e.g. when extending tracks.
+
+    INPUT:
+     - array:np.ndarray, the per-event array, with events along axis
+     - new_values:np.ndarray, the values of the new events
+     - buffer:np.ndarray or str, the storage returned by a previous call. Either an array with spare capacity,
+     which array is a view of, or an appendable .npy file (see NpyAppender.reopen) which array is memory-mapped from.
+     Otherwise array is copied into a new array with twice the required capacity.
+     - axis:int, the event axis, -1 or 0
+
+    OUTPUT:
+     - array:np.ndarray, the extended array, a view of buffer
+     - buffer:np.ndarray or str, the storage to pass to the next call
+    '''
+
+    n, n_new = array.shape[axis], new_values.shape[axis]
+
+    # Memory-mapped outputs of the chunked mode are extended on disk
+    if(isinstance(buffer,str)):
+        if(isinstance(array,np.memmap) and (array.filename==buffer)):
+            try:
+                appender = NpyAppender.reopen(buffer)
+            except ValueError:
+                appender = None
+            if((appender is not None) and (appender.n_event==n)):
+                appender.append(new_values)
+                return appender.close(), buffer
+            elif(appender is not None):
+                appender.file.close()
+        buffer = None
+
+    def events(stop:int) -> Tuple:
+        return (Ellipsis,slice(0,stop)) if axis==-1 else (slice(0,stop),)
+
+    if((buffer is None) or (array.base is not buffer) or (buffer.shape[axis] < n+n_new)):
+        shape = list(array.shape)
+        shape[axis] = max(2*(n+n_new),16)
+        # Events are contiguous, so that the array is a contiguous view of the buffer
+        new_buffer = np.empty(shape,dtype=array.dtype,order='F' if axis==-1 else 'C')
+        new_buffer[events(n)] = array
+        buffer = new_buffer
+
+    buffer[(Ellipsis,slice(n,n+n_new)) if axis==-1 else (slice(n,n+n_new),)] = new_values
+    return buffer[events(n+n_new)], buffer
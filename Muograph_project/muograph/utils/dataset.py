@@ -0,0 +1,187 @@
+import numpy as np
+import os
+import glob
+import time
+import itertools
+from functools import partial
+from typing import List, Union, Optional, Iterator
+
+# Muograph
+import sys
+sys.path.insert(1,'../muograph/')
+from utils.utils import get_hits_from_csv, iter_hits, load_hits_compact
+from utils.arrays import NpyAppender, append_to_buffer
+
+
+def _read_hits_file(filename:str, dtype:np.dtype, use_cache:bool, cache_dir:Optional[str]) -> np.ndarray:
+
+    '''
+    Reads a whole hits file in a worker process.
+    '''
+
+    if(filename.endswith('.npy')):
+        return np.load(filename).astype(dtype,copy=False)
+    if(filename.endswith('.npz')):
+        return load_hits_compact(filename,dtype=dtype)
+    return np.asarray(get_hits_from_csv(filename,dtype=dtype,verbose=False,use_cache=use_cache,cache_dir=cache_dir))
+
+
+class HitsDataset():
+
+    '''
+    Hits of an exposure split across several files, e.g. one csv file per run.
+
+    Files are read in a process pool, and either concatenated into a single hits array (see load), optionally
+    memory-mapped, or yielded chunk by chunk (see iter_chunks). Events are ordered as the files, and the event
+    offset of each file is kept in offsets, so that events can be traced back to their file (see file_of_event).
+    '''
+
+    def __init__(self,
+                 files:Union[str,List[str]],
+                 dtype:np.dtype=np.float64,
+                 n_workers:Optional[int]=None,
+                 use_cache:bool=True,
+                 cache_dir:Optional[str]=None):
+
+        '''
+        INPUT:
+         - files:str or List[str], a glob pattern (e.g. '../data/run_*.csv') or a list of csv, .npy or compact .npz hits files
+         - dtype:np.dtype, the hits floating point precision
+         - n_workers:int, the number of worker processes. If None, the number of cpu cores is used
+         - use_cache:bool, cache_dir:str, the csv binary cache options, see get_hits_from_csv
+        '''
+
+        self.files = sorted(glob.glob(files)) if isinstance(files,str) else list(files)
+        if(len(self.files)==0):
+            raise ValueError('No hits file found for {}'.format(files))
+
+        self.dtype = np.dtype(dtype)
+        self.n_workers = os.cpu_count() if n_workers is None else n_workers
+        self.use_cache, self.cache_dir = use_cache, cache_dir
+
+        # Number of events per file, and event offset of each file, known once the files are read
+        self.n_events, self.offsets = None, None
+
+    @property
+    def n_event(self) -> Optional[int]:
+        return None if self.offsets is None else int(self.offsets[-1])
+
+    def read_files(self) -> Iterator[np.ndarray]:
+
+        '''
+        Reads the files, in a process pool if n_workers > 1, and yields their hits in the files order.
+        At most n_workers files are read ahead of the one being yielded, so that memory stays bounded.
+        '''
+
+        read = partial(_read_hits_file,dtype=self.dtype,use_cache=self.use_cache,cache_dir=self.cache_dir)
+
+        if((self.n_workers<=1) | (len(self.files)==1)):
+            for filename in self.files:
+                yield read(filename)
+        else:
+            from collections import deque
+            from concurrent.futures import ProcessPoolExecutor
+            with ProcessPoolExecutor(max_workers=min(self.n_workers,len(self.files))) as executor:
+                files = iter(self.files)
+                tasks = deque(executor.submit(read,filename) for filename in itertools.islice(files,self.n_workers))
+                while(len(tasks)>0):
+                    hits = tasks.popleft().result()
+                    # A new file is submitted as each result is consumed
+                    for filename in itertools.islice(files,1):
+                        tasks.append(executor.submit(read,filename))
+                    yield hits
+                    del hits
+
+    def set_offsets(self, n_events:List[int]) -> None:
+
+        self.n_events = np.array(n_events,dtype=int)
+        self.offsets = np.concatenate([[0],np.cumsum(self.n_events)])
+
+    def load(self, output:Optional[str]=None) -> np.ndarray:
+
+        '''
+        Reads all the files and concatenates their hits.
+
+        In memory, the hits array is allocated for len(files) files of the size of the first one, and its capacity is
+        doubled whenever the files are larger (see append_to_buffer), so that files are read only once.
+
+        INPUT:
+         - output:str, a new .npy file where the hits are written and memory-mapped. If None, hits are kept in memory.
+
+        OUTPUT:
+         - hits:np.ndarray, the hits with shape (3,n_plane,n_event)
+        '''
+
+        if(output is not None):
+            assert (os.path.isfile(output)==False), '{} file already exists!'.format(output)
+
+        start = time.time()
+        print("Reading {} files with {} workers...".format(len(self.files),self.n_workers))
+
+        # Each file is written into the output as it is read, without keeping the files hits
+        hits, buffer, appender, n_events = None, None, None, []
+        for file_hits in self.read_files():
+            if(output is not None):
+                if(appender is None):
+                    appender = NpyAppender(output,self.dtype,file_hits.shape[:-1])
+                appender.append(file_hits)
+            else:
+                if(hits is None):
+                    # Capacity estimated from the first file, as files of an exposure usually have similar sizes
+                    buffer = np.empty(file_hits.shape[:-1]+(len(self.files)*file_hits.shape[-1],),dtype=self.dtype,order='F')
+                    hits = buffer[...,:0]
+                hits, buffer = append_to_buffer(hits,file_hits,buffer)
+            n_events.append(file_hits.shape[-1])
+        self.set_offsets(n_events)
+
+        if(output is not None):
+            hits = appender.close()
+
+        duration = time.time()-start
+        print("{} events read in {:.2f} s ({:.0f} events/s)".format(self.n_event,duration,self.n_event/max(duration,1e-9)))
+        return hits
+
+    def iter_chunks(self, chunk_size:int=100000) -> Iterator[np.ndarray]:
+
+        '''
+        Yields the hits chunk by chunk, e.g. for Tracking chunked mode or poca_stream_reconstruction. With n_workers > 1,
+        whole files are read in the process pool, at most n_workers files ahead of their chunks. Otherwise files are read chunk by chunk (see iter_hits),
+        with constant memory. Chunks do not span several files. offsets are set once all chunks are yielded.
+
+        INPUT:
+         - chunk_size:int, the maximum number of events per chunk
+
+        OUTPUT:
+         - chunks:Iterator[np.ndarray], the hits chunks with shape (3,n_plane,chunk)
+        '''
+
+        n_events = []
+        if(self.n_workers<=1):
+            for filename in self.files:
+                n_events.append(0)
+                for chunk in iter_hits(filename,chunk_size=chunk_size,dtype=self.dtype):
+                    n_events[-1] += chunk.shape[-1]
+                    yield chunk
+        else:
+            for file_hits in self.read_files():
+                n_events.append(file_hits.shape[-1])
+                for start in range(0,file_hits.shape[-1],chunk_size):
+                    yield file_hits[:,:,start:start+chunk_size]
+        self.set_offsets(n_events)
+
+    def file_of_event(self, event:Union[int,np.ndarray]) -> tuple:
+
+        '''
+        Finds the file an event comes from.
+
+        INPUT:
+         - event:int or np.ndarray, the event index(es) in the dataset
+
+        OUTPUT:
+         - file_index:int or np.ndarray, the index of the file in self.files
+         - file_event:int or np.ndarray, the event index within that file
+        '''
+
+        assert self.offsets is not None, 'Files must be read first, see load or iter_chunks'
+        file_index = np.searchsorted(self.offsets,event,side='right')-1
+        return file_index, event-self.offsets[file_index]
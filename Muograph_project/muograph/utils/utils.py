@@ -1,20 +1,359 @@
 import pandas as pd
 import numpy as np
+import os
+import re
+import time
+import hashlib
+from typing import List, Tuple, Optional, Iterator, Iterable, Union
+
+# Hits columns X0,Y0,Z0,...,Xn,Yn,Zn
+hit_column_pattern = re.compile(r'^([XYZ])(\d+)$')
+
+
+def get_hit_columns(filename:str) -> Tuple[List[str],int]:
+
+    '''
+    Reads the csv header and finds the hits columns, ignoring any other column (e.g. Event).
+
+    INPUT:
+     - filename:str, the csv file
+
+    OUTPUT:
+     - columns:List[str], the hits columns ordered as X0,...,Xn,Y0,...,Yn,Z0,...,Zn
+     - n_plane:int, the number of detection planes
+    '''
+
+    header = pd.read_csv(filename,nrows=0).columns
+    matches = [hit_column_pattern.match(col) for col in header]
+    planes = sorted({int(match.group(2)) for match in matches if match is not None})
+    n_plane = len(planes)
+
+    columns = [coord+str(plane) for coord in 'XYZ' for plane in range(n_plane)]
+    missing = set(columns) - set(header)
+    if(len(missing)>0):
+        raise ValueError('{} is missing hits columns {}'.format(filename,sorted(missing)))
+
+    return columns, n_plane
+
+
+def get_cache_filename(filename:str, dtype:np.dtype, cache_dir:Optional[str]=None) -> Tuple[str,str]:
+
+    '''
+    Returns the cache file of a csv hits file, keyed on the csv path, size and modification time, and on dtype.
+
+    INPUT:
+     - filename:str, the csv file
+     - dtype:np.dtype, the hits floating point precision
+     - cache_dir:str, the cache directory. If None, .hits_cache/ next to the csv file.
+
+    OUTPUT:
+     - cache_filename:str, the .npy cache file
+     - prefix:str, the prefix shared by the cache files of the csv file with dtype, whatever its size and modification time
+    '''
+
+    path = os.path.abspath(filename)
+    if(cache_dir is None):
+        cache_dir = os.path.join(os.path.dirname(path),'.hits_cache')
+
+    stat = os.stat(path)
+    path_key = hashlib.sha1(path.encode()).hexdigest()[:8]
+    state_key = hashlib.sha1('{}_{}'.format(stat.st_size,stat.st_mtime_ns).encode()).hexdigest()[:8]
+
+    prefix = os.path.join(cache_dir,'{}_{}_{}_'.format(os.path.splitext(os.path.basename(path))[0],path_key,np.dtype(dtype).name))
+    return prefix+state_key+'.npy', prefix
+
+
+def evict_hits_cache(cache_dir:str, max_cache_size:float, keep:Optional[str]=None) -> None:
+
+    '''
+    Removes the least recently used cache files until the cache directory size is below max_cache_size.
+
+    INPUT:
+     - cache_dir:str, the cache directory
+     - max_cache_size:float, the maximum cache directory size in bytes
+     - keep:str, a cache file never removed, e.g. the one just written
+    '''
+
+    files = [os.path.join(cache_dir,f) for f in os.listdir(cache_dir) if f.endswith('.npy')]
+    files = sorted(files,key=os.path.getmtime)
+    total_size = sum(os.path.getsize(f) for f in files)
+
+    for f in files:
+        if(total_size <= max_cache_size):
+            break
+        if(f!=keep):
+            total_size -= os.path.getsize(f)
+            os.remove(f)
+
+
+def clear_hits_cache(cache_dir:str) -> None:
+
+    '''
+    Removes all the cache files of a cache directory.
+    '''
+
+    evict_hits_cache(cache_dir,max_cache_size=0)
+
+
+def get_hits_from_csv(filename:str,
+                      dtype:np.dtype=np.float64,
+                      engine:Optional[str]=None,
+                      verbose:bool=True,
+                      use_cache:bool=True,
+                      cache_dir:Optional[str]=None,
+                      max_cache_size:float=4e9) -> np.ndarray:
+
+    '''
+    Reads the hits from a csv file with columns X0,Y0,Z0,...,Xn,Yn,Zn.
+
+    Only the hits columns are parsed, as float64 whatever dtype, so that results do not depend on the precision,
+    and are written into a preallocated hits array.
+
+    With use_cache, the hits are also saved in a binary .npy cache file, keyed on the csv path, size and modification time.
+    Later reads memory-map the cache file instead of parsing the csv (copy-on-write, so that the hits can still be modified
+    in memory). Cache files of a modified csv are replaced, and the least recently used cache files are removed when
+    the cache directory exceeds max_cache_size.
+
+    INPUT:
+     - filename:str, the csv file
+     - dtype:np.dtype, the hits floating point precision (e.g. np.float32 to halve memory)
+     - engine:str, the pandas csv parser engine, 'c' if None. The multithreaded 'pyarrow' engine (engine='pyarrow', if pyarrow is installed)
+     is faster, but its float parsing can differ from the 'c' engine by 1 ULP for values written with 17 significant digits.
+     With use_cache, the cached hits are those of the engine used when the cache was written.
+     - verbose:bool, if True, prints the number of rows read per second
+     - use_cache:bool, if True, the binary cache is used
+     - cache_dir:str, the cache directory. If None, .hits_cache/ next to the csv file.
+     - max_cache_size:float, the maximum cache directory size in bytes
+
+    OUTPUT:
+     - hits:np.ndarray, the hits with shape (3,n_plane,n_event)
+    '''
+
+    start = time.time()
+
+    if(use_cache):
+        cache_filename, prefix = get_cache_filename(filename,dtype,cache_dir)
+        if(os.path.isfile(cache_filename)):
+            # Last use time, for eviction
+            os.utime(cache_filename)
+            hits = np.load(cache_filename,mmap_mode='c')
+            if(verbose):
+                print("{} events loaded from cache {} in {:.3f} s".format(hits.shape[-1],cache_filename,time.time()-start))
+            return hits
+
+    # Compute # planes from csv header
+    columns, n_plane = get_hit_columns(filename)
+
+    df = pd.read_csv(filename,usecols=columns,dtype={col:np.float64 for col in columns},engine='c' if engine is None else engine)
+
+    # Create array
+    hits = np.empty((3,n_plane,len(df)),dtype=dtype)
 
-def get_hits_from_csv(filename:str,) -> np.ndarray:
-    
-    df = pd.read_csv(filename)
-    
-    # Compute # planes from csv
-    n_plane = len([col for col in df.columns if "X" in col])
-    
-    # Create array 
-    hits = np.zeros((3,n_plane,len(df)))
-    
     # Fill in array with csv file entries
-    for plane in range(n_plane):
-        hits[0,plane] = df['X'+str(plane)]
-        hits[1,plane] = df['Y'+str(plane)]    
-        hits[2,plane] = df['Z'+str(plane)]
+    for dim, coord in enumerate('XYZ'):
+        for plane in range(n_plane):
+            np.copyto(hits[dim,plane],df[coord+str(plane)].to_numpy(),casting='same_kind')
+
+    if(verbose):
+        duration = time.time()-start
+        print("{} rows read in {:.2f} s ({:.0f} rows/s)".format(len(df),duration,len(df)/max(duration,1e-9)))
+
+    if(use_cache):
+        try:
+            os.makedirs(os.path.dirname(cache_filename),exist_ok=True)
+
+            # Cache files of previous versions of the csv file
+            for f in os.listdir(os.path.dirname(cache_filename)):
+                if(os.path.join(os.path.dirname(cache_filename),f).startswith(prefix)):
+                    os.remove(os.path.join(os.path.dirname(cache_filename),f))
+
+            # Written under a temporary name, so that an interrupted write is never read
+            np.save(cache_filename+'.tmp.npy',hits)
+            os.replace(cache_filename+'.tmp.npy',cache_filename)
+            evict_hits_cache(os.path.dirname(cache_filename),max_cache_size,keep=cache_filename)
+        except OSError as error:
+            print("Hits cache not written: {}".format(error))
 
     return hits
+
+
+def save_hits_compact(hits:Union[np.ndarray,Iterable[np.ndarray]],
+                      filename:str,
+                      scale:float=1e-3,
+                      compress:bool=True,
+                      compression_level:int=6) -> None:
+
+    '''
+    Saves hits in a compact binary .npz file. Hits are written block by block, each block being an array chunk.
+    X and Y are quantized as int32 multiples of scale (1 micrometre by default), i.e. with a maximum error of scale/2.
+    Z positions are mostly constant per plane: the most frequent Z position of each plane is stored once, as float64,
+    and only the Z positions differing from it are stored, as quantized offsets with their (plane,event) indices.
+    Blocks where most Z positions differ are stored with all their quantized Z positions.
+
+    INPUT:
+     - hits:np.ndarray or Iterable[np.ndarray], the hits with shape (3,n_plane,n_event), or hits chunks (e.g. from iter_hits)
+     - filename:str, the .npz output file
+     - scale:float, the quantization step in mm
+     - compress:bool, if True, blocks are zlib compressed
+     - compression_level:int, the zlib compression level, from 1 (fastest) to 9 (smallest)
+    '''
+
+    import zipfile
+
+    def write(archive:zipfile.ZipFile, name:str, array:np.ndarray) -> None:
+        with archive.open(name+'.npy','w',force_zip64=True) as f:
+            np.lib.format.write_array(f,np.asarray(array),allow_pickle=False)
+
+    def quantize(coords:np.ndarray) -> np.ndarray:
+        quantized = np.rint(np.asarray(coords,dtype=np.float64)/scale)
+        if(not np.all(np.abs(quantized)<2**31)):
+            raise ValueError('Hits are not finite or exceed the int32 range with scale {} mm'.format(scale))
+        return quantized.astype(np.int32)
+
+    if(isinstance(hits,np.ndarray)):
+        hits = [hits]
+
+    z_planes, n_event, n_block = None, 0, 0
+    with zipfile.ZipFile(filename,'w',compression=zipfile.ZIP_DEFLATED if compress else zipfile.ZIP_STORED,
+                         compresslevel=compression_level if compress else None,allowZip64=True) as archive:
+
+        for block in hits:
+            if(block.shape[-1]==0):
+                continue
+
+            # Planes Z positions, the most frequent ones of the first block
+            if(z_planes is None):
+                z_planes = np.empty(block.shape[1],dtype=np.float64)
+                for plane in range(block.shape[1]):
+                    values, counts = np.unique(block[2,plane],return_counts=True)
+                    z_planes[plane] = values[np.argmax(counts)]
+
+            write(archive,'xy_{}'.format(n_block),quantize(block[:2]))
+
+            planes, events = np.nonzero(block[2]!=z_planes[:,np.newaxis])
+            if(2*len(planes)>block[2].size):
+                write(archive,'z_{}'.format(n_block),quantize(block[2]))
+            elif(len(planes)>0):
+                write(archive,'z_index_{}'.format(n_block),np.stack([planes,events]).astype(np.int32))
+                write(archive,'z_delta_{}'.format(n_block),quantize(block[2,planes,events]-z_planes[planes]))
+
+            n_event += block.shape[-1]
+            n_block += 1
+
+        write(archive,'scale',np.float64(scale))
+        write(archive,'n_event',np.int64(n_event))
+        write(archive,'n_block',np.int64(n_block))
+        write(archive,'z',np.zeros(0) if z_planes is None else z_planes)
+
+
+def iter_hits_compact(filename:str, dtype:np.dtype=np.float64, out:Optional[np.ndarray]=None) -> Iterator[np.ndarray]:
+
+    '''
+    Decodes the blocks of a compact hits file (see save_hits_compact) one by one.
+
+    INPUT:
+     - filename:str, the compact hits .npz file
+     - dtype:np.dtype, the hits floating point precision
+     - out:np.ndarray, a hits array with shape (3,n_plane,n_event) into which blocks are decoded. If None, each block is decoded into a new array.
+
+    OUTPUT:
+     - blocks:Iterator[np.ndarray], the hits blocks with shape (3,n_plane,block)
+    '''
+
+    with np.load(filename) as archive:
+        scale = archive['scale'][()]
+        z_planes = archive['z']
+
+        start = 0
+        for k in range(int(archive['n_block'])):
+            xy = archive['xy_{}'.format(k)]
+            if(out is None):
+                block = np.empty((3,)+xy.shape[1:],dtype=dtype)
+            else:
+                block = out[:,:,start:start+xy.shape[-1]]
+            start += xy.shape[-1]
+
+            np.multiply(xy,scale,out=block[:2],casting='same_kind')
+            if('z_{}'.format(k) in archive.files):
+                np.multiply(archive['z_{}'.format(k)],scale,out=block[2],casting='same_kind')
+            else:
+                np.copyto(block[2],z_planes[:,np.newaxis],casting='same_kind')
+                if('z_index_{}'.format(k) in archive.files):
+                    planes, events = archive['z_index_{}'.format(k)]
+                    block[2,planes,events] = z_planes[planes] + archive['z_delta_{}'.format(k)]*scale
+            yield block
+
+
+def load_hits_compact(filename:str, dtype:np.dtype=np.float64) -> np.ndarray:
+
+    '''
+    Reads the hits from a compact hits file (see save_hits_compact), decoding blocks straight into the hits array.
+
+    INPUT:
+     - filename:str, the compact hits .npz file
+     - dtype:np.dtype, the hits floating point precision
+
+    OUTPUT:
+     - hits:np.ndarray, the hits with shape (3,n_plane,n_event)
+    '''
+
+    with np.load(filename) as archive:
+        n_event = int(archive['n_event'])
+        n_plane = archive['xy_0'].shape[1] if n_event>0 else 0
+
+    hits = np.empty((3,n_plane,n_event),dtype=dtype)
+    for _ in iter_hits_compact(filename,dtype=dtype,out=hits):
+        pass
+    return hits
+
+
+def iter_hits(filename:str, chunk_size:int=100000, dtype:np.dtype=np.float64, engine:Optional[str]=None) -> Iterator[np.ndarray]:
+
+    '''
+    Reads a hits file chunk by chunk, so that files of any size can be processed with constant memory.
+    Chunks can be given to Tracking (as an iterable of chunks), or processed one by one with Tracking, POCA
+    and VoxelAccumulator (see poca_stream_reconstruction).
+
+    INPUT:
+     - filename:str, a csv file with columns X0,Y0,Z0,...,Xn,Yn,Zn, a .npy file with hits of shape (3,n_plane,n_event),
+     or a compact hits .npz file (see save_hits_compact)
+     - chunk_size:int, the number of events per chunk
+     - dtype:np.dtype, the hits floating point precision
+     - engine:str, the pandas csv parser engine, 'c' if None, as the 'pyarrow' engine does not read csv files by chunks
+
+    OUTPUT:
+     - chunks:Iterator[np.ndarray], the hits chunks with shape (3,n_plane,chunk)
+    '''
+
+    if(filename.endswith('.npy')):
+        hits = np.load(filename,mmap_mode='r')
+        for start in range(0,hits.shape[-1],chunk_size):
+            yield np.array(hits[:,:,start:start+chunk_size],dtype=dtype)
+        return
+
+    if(filename.endswith('.npz')):
+        # Blocks are decoded once, and split or merged into chunks of chunk_size events
+        pending = []
+        for block in iter_hits_compact(filename,dtype=dtype):
+            pending.append(block)
+            n_pending = sum(b.shape[-1] for b in pending)
+            if(n_pending>=chunk_size):
+                buffer = np.concatenate(pending,axis=-1) if len(pending)>1 else pending[0]
+                n_chunk = n_pending//chunk_size*chunk_size
+                for start in range(0,n_chunk,chunk_size):
+                    yield buffer[:,:,start:start+chunk_size]
+                pending = [buffer[:,:,n_chunk:]]
+        if(sum(b.shape[-1] for b in pending)>0):
+            yield np.concatenate(pending,axis=-1)
+        return
+
+    columns, n_plane = get_hit_columns(filename)
+    reader = pd.read_csv(filename,usecols=columns,dtype={col:np.float64 for col in columns},
+                         engine='c' if engine is None else engine,chunksize=chunk_size)
+
+    for df in reader:
+        chunk = np.empty((3,n_plane,len(df)),dtype=dtype)
+        for dim, coord in enumerate('XYZ'):
+            for plane in range(n_plane):
+                np.copyto(chunk[dim,plane],df[coord+str(plane)].to_numpy(),casting='same_kind')
+        yield chunk
@@ -0,0 +1,294 @@
+# Usual suspects
+import numpy as np
+from typing import Union, Tuple, Optional
+import functools
+
+# Muograph
+import sys
+sys.path.insert(1,'../muograph/')
+from volume.volume import VolumeInterest
+from reconstruction.voxel_scores import VoxelScores, group_by_voxel
+
+
+class OctreeVolume():
+
+    '''
+    Sparse adaptive voxelization of a volume of interest, for large and mostly empty scenes.
+
+    The volume is divided into root cells of width root_width. Occupied cells are recursively split into 8 children
+    of half width where POCA points are dense or their scores spread, down to max_level. Only occupied leaf cells are
+    stored, along with the count, sum and sum of squares of their scores, so that memory scales with the number of
+    occupied cells instead of the full grid.
+
+    Cells of level l have width root_width/2**l, and are indexed by their integer position (ix,iy,iz) in the regular
+    grid of level l, n_root_xyz*2**l cells wide. Any level can be exported as a dense array (see to_dense), with the
+    matching VolumeInterest (see to_volume).
+    '''
+
+    def __init__(self,
+                 position:Tuple[float],
+                 dimension:Tuple[float],
+                 root_width:Union[float,Tuple[float]]=80,
+                 max_level:int=3,
+                 dtype:np.dtype=np.float64):
+
+        '''
+        position = [x,y,z] in mm
+        dimension = [dx,dy,dz] in mm
+        root_width = the root cells width in mm, either a single width or one width per axis
+        max_level = the maximum number of splits, the finest cells have width root_width/2**max_level
+        dtype = floating point precision of the cells positions
+        '''
+
+        self.dtype = np.dtype(dtype)
+        self.xyz = np.array(position)
+        self.dxyz = np.array(dimension)
+        self.xyz_min = self.xyz - self.dxyz/2
+        self.xyz_max = self.xyz + self.dxyz/2
+
+        self.root_width = np.broadcast_to(np.asarray(root_width,dtype=np.float64),(3,)).copy()
+        self.max_level = max_level
+
+        n_root_xyz = self.dxyz/self.root_width
+        if(np.any(np.abs(n_root_xyz-np.round(n_root_xyz))>1e-9*np.maximum(n_root_xyz,1))):
+            raise ValueError('Root cell size {} does not match VOI dimensions {}. '.format(root_width,self.dxyz) +
+                             'Please make sure that dimension / root_width = integer')
+        self.n_root_xyz = np.round(n_root_xyz).astype(int)
+
+        # Occupied leaf cells, their level and indices at that level
+        self.leaf_levels = np.zeros(0,dtype=int)
+        self.leaf_indices = np.zeros((0,3),dtype=int)
+
+        # Leaf cells statistics
+        self.counts = np.zeros(0,dtype=np.int64)
+        self.sums, self.sums_sq = np.zeros(0), np.zeros(0)
+
+        # Per level sorted flat indices of the leaf cells, and matching leaf ids, for point location
+        self._level_lookup = {}
+
+    @property
+    def n_leaf(self) -> int:
+        return len(self.leaf_levels)
+
+    def cell_width(self, level:int) -> np.ndarray:
+        return self.root_width/2**level
+
+    def n_cells_xyz(self, level:int) -> np.ndarray:
+        return self.n_root_xyz*2**level
+
+    def cell_indices(self, points:np.ndarray, level:int) -> np.ndarray:
+
+        '''
+        Computes the indices of the level cells containing points, in O(1) per point.
+
+        INPUT:
+         - points:np.ndarray, the points coordinates with shape (n_point,3)
+         - level:int, the cells level
+
+        OUTPUT:
+         - indices:np.ndarray, the cells indices with shape (n_point,3), [-1,-1,-1] outside the volume
+        '''
+
+        with np.errstate(invalid='ignore'):
+            indices = np.floor((points - self.xyz_min)/self.cell_width(level))
+        inside = np.all((indices>=0) & (indices<self.n_cells_xyz(level)),axis=1)
+        indices = np.where(inside[:,np.newaxis],indices,-1.).astype(int)
+        return indices
+
+    def flat_indices(self, indices:np.ndarray, level:int) -> np.ndarray:
+        return np.ravel_multi_index(tuple(indices.T),tuple(self.n_cells_xyz(level)))
+
+    def build(self,
+              poca_points:np.ndarray,
+              scores:Optional[np.ndarray]=None,
+              max_count:int=50,
+              max_std:Optional[float]=None,
+              min_count:int=10) -> None:
+
+        '''
+        Builds the leaf cells from POCA points. Starting from the occupied root cells, a cell is split into its 8 children
+        when it holds more than max_count points, or when the standard deviation of its scores exceeds max_std with at least
+        min_count points. Children without any point are not stored.
+
+        INPUT:
+         - poca_points:np.ndarray, the POCA points with shape (n_event,3). Points outside the volume are ignored.
+         - scores:np.ndarray, the score of each POCA point (e.g. dtheta), with size (n_event). If None, cells are only
+         refined according to the POCA points density.
+         - max_count:int, cells with more than max_count points are split
+         - max_std:float, cells whose scores standard deviation exceeds max_std are split. If None, scores are not used for refinement.
+         - min_count:int, the minimum number of points for the scores standard deviation to be used
+        '''
+
+        if(scores is None):
+            scores = np.zeros(len(poca_points))
+        scores = np.asarray(scores,dtype=np.float64)
+
+        inside = self.cell_indices(poca_points,0)[:,0]>=0
+        points, scores = poca_points[inside], scores[inside]
+
+        leaf_levels, leaf_indices, counts, sums, sums_sq = [], [], [], [], []
+        for level in range(self.max_level+1):
+            if(len(points)==0):
+                break
+
+            # Occupied cells of this level and their statistics
+            indices = self.cell_indices(points,level)
+            cells, inverse, n = np.unique(self.flat_indices(indices,level),return_inverse=True,return_counts=True)
+            s, s_sq = np.bincount(inverse,weights=scores), np.bincount(inverse,weights=scores**2)
+
+            split = n > max_count
+            if(max_std is not None):
+                var = np.maximum(s_sq/n - (s/n)**2,0.)
+                split |= (n >= min_count) & (var > max_std**2)
+            if(level==self.max_level):
+                split[:] = False
+
+            leaf_levels.append(np.full((~split).sum(),level))
+            leaf_indices.append(np.stack(np.unravel_index(cells[~split],tuple(self.n_cells_xyz(level))),axis=-1))
+            counts.append(n[~split])
+            sums.append(s[~split])
+            sums_sq.append(s_sq[~split])
+
+            # Points of the split cells are located at the next level
+            refine = split[inverse]
+            points, scores = points[refine], scores[refine]
+
+        self.leaf_levels = np.concatenate(leaf_levels) if leaf_levels else np.zeros(0,dtype=int)
+        self.leaf_indices = np.concatenate(leaf_indices) if leaf_indices else np.zeros((0,3),dtype=int)
+        self.counts = np.concatenate(counts) if counts else np.zeros(0,dtype=np.int64)
+        self.sums = np.concatenate(sums) if sums else np.zeros(0)
+        self.sums_sq = np.concatenate(sums_sq) if sums_sq else np.zeros(0)
+
+        self._level_lookup = {}
+        for level in np.unique(self.leaf_levels):
+            leaves = np.flatnonzero(self.leaf_levels==level)
+            keys = self.flat_indices(self.leaf_indices[leaves],level)
+            order = np.argsort(keys)
+            self._level_lookup[level] = (keys[order],leaves[order])
+
+    def locate(self, points:np.ndarray) -> np.ndarray:
+
+        '''
+        Finds the leaf cell containing each point, with a binary search among the leaf cells of each level.
+
+        INPUT:
+         - points:np.ndarray, the points coordinates with shape (n_point,3)
+
+        OUTPUT:
+         - leaves:np.ndarray, the leaf id of each point, with size (n_point). -1 outside the volume or in empty cells.
+        '''
+
+        leaves = np.full(len(points),-1)
+        for level, (keys, leaf_ids) in self._level_lookup.items():
+            indices = self.cell_indices(points,level)
+            inside = np.flatnonzero((indices[:,0]>=0) & (leaves<0))
+            flat = self.flat_indices(indices[inside],level)
+            position = np.minimum(np.searchsorted(keys,flat),len(keys)-1)
+            found = keys[position]==flat
+            leaves[inside[found]] = leaf_ids[position[found]]
+        return leaves
+
+    def leaf_centers(self) -> np.ndarray:
+
+        '''
+        Returns the leaf cells centers with shape (n_leaf,3).
+        '''
+
+        widths = self.root_width/2.**self.leaf_levels[:,np.newaxis]
+        return (self.xyz_min + (self.leaf_indices+.5)*widths).astype(self.dtype)
+
+    def leaf_widths(self) -> np.ndarray:
+        return (self.root_width/2.**self.leaf_levels[:,np.newaxis]).astype(self.dtype)
+
+    def mean(self) -> np.ndarray:
+        return self.sums/self.counts
+
+    def rms(self) -> np.ndarray:
+        return np.sqrt(self.sums_sq/self.counts)
+
+    def var(self) -> np.ndarray:
+        return np.maximum(self.sums_sq/self.counts - self.mean()**2,0.)
+
+    def std(self) -> np.ndarray:
+        return np.sqrt(self.var())
+
+    def compute_leaf_scores(self,
+                            poca_points:np.ndarray,
+                            scores:np.ndarray,
+                            score_method:Union[functools.partial,str]=functools.partial(np.quantile,q=.5)) -> np.ndarray:
+
+        '''
+        Computes a final score per leaf cell from the scores of the POCA points it contains, e.g. the median dtheta.
+
+        INPUT:
+         - poca_points:np.ndarray, the POCA points with shape (n_event,3)
+         - scores:np.ndarray, the score of each POCA point, with size (n_event)
+         - score_method:functools.partial or str, see VoxelScores.reduce
+
+        OUTPUT:
+         - leaf_scores:np.ndarray, the final score of each leaf cell, with size (n_leaf). 0 for leaves without any point.
+        '''
+
+        leaves = self.locate(poca_points)
+        indices = np.stack([leaves,np.zeros_like(leaves),np.zeros_like(leaves)],axis=-1)
+        n_vox_xyz = np.array([self.n_leaf,1,1])
+
+        event_order, offsets = group_by_voxel(indices,n_vox_xyz)
+        score_list = VoxelScores(scores=scores,event_order=event_order,offsets=offsets,n_vox_xyz=n_vox_xyz)
+        return score_list.reduce(score_method)[:,0,0]
+
+    def to_dense(self, values:np.ndarray, level:int, extensive:bool=False) -> np.ndarray:
+
+        '''
+        Exports per leaf values to a dense array at a given level. Leaf cells coarser than level fill all their sub-cells,
+        and leaf cells finer than level are combined into their ancestor cell.
+
+        INPUT:
+         - values:np.ndarray, the value of each leaf cell, with size (n_leaf), e.g. mean() or compute_leaf_scores
+         - level:int, the level of the dense array
+         - extensive:bool, if True, values are quantities such as counts, split evenly among sub-cells and summed into ancestor cells.
+         Otherwise values are averaged into ancestor cells, weighted by the leaf cells counts.
+
+        OUTPUT:
+         - dense:np.ndarray, the dense array with shape n_cells_xyz(level), 0 in empty cells
+        '''
+
+        n_cells = tuple(self.n_cells_xyz(level))
+        weighted_sum, weights = np.zeros(int(np.prod(n_cells))), np.zeros(int(np.prod(n_cells)))
+
+        for leaf_level in np.unique(self.leaf_levels):
+            leaves = np.flatnonzero(self.leaf_levels==leaf_level)
+            indices, value, count = self.leaf_indices[leaves], values[leaves], self.counts[leaves].astype(float)
+
+            if(leaf_level > level):
+                # Ancestor cell at level
+                indices = indices//2**(leaf_level-level)
+                fraction = 1.
+            else:
+                # Every sub-cell at level
+                factor = 2**(level-leaf_level)
+                offsets = np.stack(np.meshgrid(*[np.arange(factor)]*3,indexing='ij'),axis=-1).reshape(-1,3)
+                indices = (indices[:,np.newaxis]*factor + offsets).reshape(-1,3)
+                value, count = np.repeat(value,len(offsets)), np.repeat(count,len(offsets))
+                fraction = 1./len(offsets)
+
+            flat = self.flat_indices(indices,level)
+            if(extensive):
+                np.add.at(weighted_sum,flat,value*fraction)
+                np.add.at(weights,flat,1.)
+            else:
+                np.add.at(weighted_sum,flat,value*count*fraction)
+                np.add.at(weights,flat,count*fraction)
+
+        if(extensive):
+            return weighted_sum.reshape(n_cells)
+        with np.errstate(invalid='ignore',divide='ignore'):
+            return np.where(weights>0,weighted_sum/weights,0.).reshape(n_cells)
+
+    def to_volume(self, level:int) -> VolumeInterest:
+
+        '''
+        Returns the VolumeInterest whose voxels are the cells of level, matching to_dense(values,level).
+        '''
+
+        return VolumeInterest(position=self.xyz,dimension=self.dxyz,voxel_width=tuple(self.cell_width(level)),dtype=self.dtype)
@@ -9,89 +9,248 @@ from IPython.display import display, Math
     
 class VolumeInterest():
 
-    def __init__(self,position:Tuple[float],dimension:Tuple[float],voxel_width:float=10):
+    def __init__(self,
+                 position:Optional[Tuple[float]]=None,
+                 dimension:Optional[Tuple[float]]=None,
+                 voxel_width:Union[float,Tuple[float]]=10,
+                 dtype:np.dtype=np.float64,
+                 edges:Optional[List[np.ndarray]]=None):
 
         '''
         position = [x,y,z] in mm
         dimension = [dx,dy,dz] in mm 
-        Voxel width = 10 mm default
+        Voxel width = 10 mm default, either a single width or one width per axis [wx,wy,wz]
+        dtype = floating point precision of the voxels positions
+        edges = optional [x_edges,y_edges,z_edges] in mm, increasing voxel edges along each axis, for non-uniform grids.
+        position and dimension are then deduced from the edges, and voxel_width is ignored.
+
+        The voxel grid is described by its origin xyz_min, the voxel widths and the number of voxels along each axis.
+        Dense voxel_centers and voxel_edges arrays are only generated when accessed.
         '''
 
+        self.dtype = np.dtype(dtype)
+
+        if(edges is not None):
+            edges = [np.asarray(edge,dtype=np.float64) for edge in edges]
+            if((len(edges)!=3) | any((edge.ndim!=1) | (len(edge)<2) for edge in edges)):
+                raise ValueError('edges must be 3 arrays with at least 2 edges each')
+            if(any(np.any(np.diff(edge)<=0) for edge in edges)):
+                raise ValueError('edges must be strictly increasing')
+            position = [(edge[0]+edge[-1])/2 for edge in edges]
+            dimension = [edge[-1]-edge[0] for edge in edges]
+        elif((position is None) | (dimension is None)):
+            raise ValueError('Either position and dimension, or edges must be provided')
+
         # VOI position
         self.xyz = np.array(position)
         
         # VOI dimensions
         self.dxyz = np.array(dimension)
-        self.dxyz = np.array(dimension)
 
         self.xyz_min = self.xyz - self.dxyz/2
         self.xyz_max = self.xyz + self.dxyz/2
 
-        # Voxel width
-        self.vox_width = voxel_width
+        # Voxel width, per axis for anisotropic grids, None for non-uniform grids
+        self.vox_width = None if edges is not None else voxel_width
+        self.uniform = [edges is None]*3
 
         # Voxelization
-        self.n_vox_xyz = self.Compute_N_voxel()
-        self.voxel_centers,self.voxel_edges = self.Generate_voxels()
+        if(edges is None):
+            self.n_vox_xyz = self.Compute_N_voxel()
+            widths = np.broadcast_to(voxel_width,(3,))
+            self.axis_centers = [self.Compute_voxel_centers(x_min_=self.xyz_min[dim],x_max_=self.xyz_max[dim],Nvoxel_=self.n_vox_xyz[dim],
+                                                            voxel_width_=widths[dim]).astype(self.dtype)
+                                 for dim in [0,1,2]]
+            self.axis_bounds = [(self.axis_centers[dim]-widths[dim]/2,self.axis_centers[dim]+widths[dim]/2) for dim in [0,1,2]]
+        else:
+            self.n_vox_xyz = np.array([len(edge)-1 for edge in edges])
+            self.axis_centers = [((edge[:-1]+edge[1:])/2).astype(self.dtype) for edge in edges]
+            self.axis_bounds = [(edge[:-1].astype(self.dtype),edge[1:].astype(self.dtype)) for edge in edges]
+
+        self._voxel_centers, self._voxel_edges = None, None
+
+    @property
+    def n_vox(self) -> int:
+        return int(np.prod(self.n_vox_xyz))
+
+    @property
+    def voxel_centers(self) -> np.ndarray:
+
+        '''
+        The voxels centers with shape (Nx,Ny,Nz,3), generated on first access.
+        '''
+
+        if(self._voxel_centers is None):
+            self._voxel_centers, self._voxel_edges = self.Generate_voxels()
+        return self._voxel_centers
+
+    @property
+    def voxel_edges(self) -> np.ndarray:
+
+        '''
+        The voxels lower (voxel_edges[...,0,:]) and upper (voxel_edges[...,1,:]) edges with shape (Nx,Ny,Nz,2,3), generated on first access.
+        '''
+
+        if(self._voxel_edges is None):
+            self._voxel_centers, self._voxel_edges = self.Generate_voxels()
+        return self._voxel_edges
 
     def Compute_N_voxel(self):
 
-        nx = self.dxyz[0]/self.vox_width
-        ny = self.dxyz[1]/self.vox_width
-        nz = self.dxyz[2]/self.vox_width
+        n_vox_xyz = self.dxyz/np.asarray(self.vox_width)
 
-        if((nx%1!=0)|(ny%1!=0)|(nz%1!=0)):
-            print('ERROR')
-            print('Voxel size does not match VOI dimensions')
-            print('Please make sure that dimension / voxel_width = integer')
-        return np.array([int(nx),int(ny),int(nz)])
+        # Tolerance on the division rounding, e.g. 0.3/0.1
+        if(np.any(np.abs(n_vox_xyz-np.round(n_vox_xyz))>1e-9*np.maximum(n_vox_xyz,1))):
+            raise ValueError('Voxel size {} does not match VOI dimensions {}. '.format(self.vox_width,self.dxyz) +
+                             'Please make sure that dimension / voxel_width = integer')
+        return np.round(n_vox_xyz).astype(int)
 
 
     def Compute_voxel_centers(self,
                               x_min_: float, 
                               x_max_: float,
-                              Nvoxel_: int) -> np.ndarray:
+                              Nvoxel_: int,
+                              voxel_width_: Optional[float] = None) -> np.ndarray:
                                     
         '''
         x_min,max border of the volume of interset for a given coordinate
+        voxel_width_ the voxel width along that coordinate, self.vox_width if None
                 
         return voxels centers position along given coordinate
         '''
+        if(voxel_width_ is None):
+            voxel_width_ = self.vox_width
         xs_ = np.linspace(x_min_,x_max_,Nvoxel_+1)
-        xs_ += self.vox_width/2
+        xs_ += voxel_width_/2
         return xs_[:-1]    
 
 
     def Generate_voxels(self)->np.ndarray:
             
-        voxels_centers = np.zeros((self.n_vox_xyz[0],self.n_vox_xyz[1],self.n_vox_xyz[2],3))
-        
-        xs_ = self.Compute_voxel_centers(x_min_=self.xyz_min[0], x_max_=self.xyz_max[0],
-                                    Nvoxel_= self.n_vox_xyz[0])
-        ys_ = self.Compute_voxel_centers(x_min_=self.xyz_min[1], x_max_=self.xyz_max[1],
-                                    Nvoxel_= self.n_vox_xyz[1])
-        zs_ = self.Compute_voxel_centers(x_min_=self.xyz_min[2], x_max_=self.xyz_max[2],
-                                    Nvoxel_= self.n_vox_xyz[2])
-                    
-        for i in range(len(ys_)):
-            for j in range(len(zs_)):
-                voxels_centers[:,i,j,0]=xs_
-        for i in range(len(xs_)):
-            for j in range(len(zs_)):
-                voxels_centers[i,:,j,1]=ys_
-        for i in range(len(xs_)):
-            for j in range(len(ys_)):
-                voxels_centers[i,j,:,2]=zs_
-        
+        voxels_centers = np.zeros((self.n_vox_xyz[0],self.n_vox_xyz[1],self.n_vox_xyz[2],3),dtype=self.dtype)
+
+        voxels_centers[:,:,:,0] = self.axis_centers[0][:,np.newaxis,np.newaxis]
+        voxels_centers[:,:,:,1] = self.axis_centers[1][np.newaxis,:,np.newaxis]
+        voxels_centers[:,:,:,2] = self.axis_centers[2][np.newaxis,np.newaxis,:]
         
-        voxels_edges = np.zeros((self.n_vox_xyz[0],self.n_vox_xyz[1],self.n_vox_xyz[2],2,3))
+        voxels_edges = np.zeros((self.n_vox_xyz[0],self.n_vox_xyz[1],self.n_vox_xyz[2],2,3),dtype=self.dtype)
 
-        voxels_edges[:,:,:,0,:] = voxels_centers-self.vox_width/2
-        voxels_edges[:,:,:,1,:] = voxels_centers+self.vox_width/2
+        for dim, axis in zip([0,1,2],[(slice(None),None,None),(None,slice(None),None),(None,None,slice(None))]):
+            voxels_edges[:,:,:,0,dim] = self.axis_bounds[dim][0][axis]
+            voxels_edges[:,:,:,1,dim] = self.axis_bounds[dim][1][axis]
 
         return voxels_centers, voxels_edges
 
 
+    def axis_edges(self, dim:int) -> Tuple[np.ndarray]:
+
+        '''
+        Returns the lower and upper edges of the voxels along axis dim, with size (n_vox_xyz[dim]),
+        equal to voxel_edges along that axis.
+        '''
+
+        return self.axis_bounds[dim]
+
+
+    def index_to_center(self, indices:np.ndarray) -> np.ndarray:
+
+        '''
+        Returns the center of voxels given their indices.
+
+        INPUT:
+         - indices:np.ndarray, the voxel indices with shape (n_point,3)
+
+        OUTPUT:
+         - centers:np.ndarray, the voxels centers with shape (n_point,3)
+        '''
+
+        return np.stack([self.axis_centers[dim][indices[:,dim]] for dim in [0,1,2]],axis=-1)
+
+
+    def find_voxel_indices(self, points:np.ndarray) -> np.ndarray:
+
+        '''
+        Finds the voxel containing each point. Along uniform axes, indices are computed from the VOI origin and
+        voxel width, in O(1) per point. Along non-uniform axes, edges are searched with np.searchsorted.
+
+        INPUT:
+         - points:np.ndarray, the points coordinates with shape (n_point,3)
+
+        OUTPUT:
+         - indices:np.ndarray, the voxel indices with shape (n_point,3). Points outside the VOI,
+         or exactly on a voxel edge, get indices [-1,-1,-1].
+        '''
+
+        indices = np.empty((len(points),3),dtype=int)
+        inside = np.ones(len(points),dtype=bool)
+
+        for dim in [0,1,2]:
+            coord = points[:,dim]
+            n_vox = self.n_vox_xyz[dim]
+
+            # Voxel edges along dim, as used for the voxels definition
+            lower, upper = self.axis_edges(dim)
+
+            if(self.uniform[dim]):
+                with np.errstate(invalid='ignore'):
+                    index = np.floor((coord - self.xyz_min[dim])/np.broadcast_to(self.vox_width,(3,))[dim])
+                index = np.clip(np.nan_to_num(index,nan=-1.),0,n_vox-1).astype(int)
+
+                # Rounding of the division may shift points close to an edge to the neighbouring voxel
+                index -= (coord <= lower[index]) & (index > 0)
+                index += (coord >= upper[index]) & (index < n_vox-1)
+            else:
+                # Last voxel whose lower edge is below the point
+                index = np.clip(np.searchsorted(lower,coord,side='left')-1,0,n_vox-1)
+
+            inside &= (coord > lower[index]) & (coord < upper[index])
+            indices[:,dim] = index
+
+        indices[~inside] = -1
+        return indices
+
+
+    def __setstate__(self, state:Dict) -> None:
+
+        # VolumeInterest instances pickled before the lazy voxels generation store the dense arrays
+        if('axis_centers' not in state):
+            state['_voxel_centers'], state['_voxel_edges'] = state.pop('voxel_centers',None), state.pop('voxel_edges',None)
+            self.__dict__.update(state)
+            self.dtype = state.get('dtype',np.dtype(np.float64))
+            self.axis_centers = [self.Compute_voxel_centers(x_min_=self.xyz_min[dim],x_max_=self.xyz_max[dim],Nvoxel_=self.n_vox_xyz[dim]).astype(self.dtype)
+                                 for dim in [0,1,2]]
+        else:
+            self.__dict__.update(state)
+
+        # Instances pickled before anisotropic and non-uniform grids
+        if('axis_bounds' not in self.__dict__):
+            self.uniform = [True]*3
+            self.axis_bounds = [(centers-self.vox_width/2,centers+self.vox_width/2) for centers in self.axis_centers]
+
+
+    def rebin(self, factor:Union[int,Tuple[int]]) -> 'VolumeInterest':
+
+        '''
+        Returns the coarser VolumeInterest whose voxels are blocks of factor voxels along each axis.
+
+        INPUT:
+         - factor:int or Tuple[int], the number of voxels merged along each axis, which must divide n_vox_xyz
+
+        OUTPUT:
+         - voi:VolumeInterest, the coarser volume of interest
+        '''
+
+        factor = np.broadcast_to(np.asarray(factor,dtype=int),(3,))
+        if(np.any(self.n_vox_xyz%factor!=0)):
+            raise ValueError('Rebinning factor {} does not divide the number of voxels {}'.format(factor.tolist(),self.n_vox_xyz.tolist()))
+
+        if(all(self.uniform)):
+            return VolumeInterest(position=self.xyz,dimension=self.dxyz,voxel_width=tuple(np.asarray(self.vox_width)*factor),dtype=self.dtype)
+
+        edges = [np.append(lower[::f],upper[-1]) for (lower,upper), f in zip(self.axis_bounds,factor)]
+        return VolumeInterest(edges=edges,dtype=self.dtype)
+
+
     def load_rad_length(self,rad_length:Optional[float]=None):
 
         self.X0 = np.zeros(([self.n_vox_xyz[0],self.n_vox_xyz[1],self.n_vox_xyz[2]]))+rad_length